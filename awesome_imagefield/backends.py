@@ -0,0 +1,216 @@
+"""
+Backends which build image versions outside of the request/response cycle.
+
+Fields declared with `deferred=True` only commit the original file in
+pre_save(); once the model instance is saved the work is handed to the
+backend named by the AWESOME_IMAGEFIELD_DEFERRED_BACKEND setting.
+"""
+import json
+import logging
+import time
+import traceback
+from datetime import timedelta
+from importlib import import_module
+
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import F, get_model
+from django.utils import timezone
+
+from . import conf, rendering
+
+logger = logging.getLogger(__name__)
+
+_backend = None
+
+
+def get_backend():
+    """Return the (shared) instance of the configured deferred backend"""
+    global _backend
+    if _backend is None:
+        module_name, class_name = conf.DEFERRED_BACKEND.rsplit('.', 1)
+        _backend = getattr(import_module(module_name), class_name)()
+    return _backend
+
+
+class StaleJob(Exception):
+    """The row no longer (or not yet) holds the original a job was queued for"""
+
+
+def original_of(instance, field):
+    """The name and content hash of the original of `field` on `instance`, as queued with a job"""
+    file = getattr(instance, field.attname)
+    if not file:
+        return None, None
+    manifest = field.get_manifest(instance, file.name)
+    return file.name, manifest.get('original_hash') if manifest else None
+
+
+def render_versions(app_label, model_name, object_pk, field_name, version_transform_data=None, original=None):
+    """
+    Load a saved model instance and build the image versions of one of its
+    fields. With `original`, as returned by original_of() when the job was
+    queued, raises StaleJob instead when the row holds a different original:
+    the save which queued the job is not committed yet, or a newer one replaced it.
+    """
+    model = get_model(app_label, model_name)
+    instance = model._default_manager.get(pk=object_pk)
+    field = instance._meta.get_field(field_name)
+    if original is not None and original_of(instance, field) != original:
+        raise StaleJob("%s.%s(%s).%s no longer holds %s" % (app_label, model_name, object_pk, field_name, original[0]))
+    file = getattr(instance, field.attname)
+    if file:
+        loaded = getattr(instance, field.manifest_field) if field.manifest_field else None
+        field.generate_versions(instance, file, version_transform_data)
+        # don't overwrite the manifest of a save committed in the meantime
+        if not field.save_manifest(instance, expected=loaded):
+            raise StaleJob("%s.%s(%s).%s was saved while its versions were built"
+                           % (app_label, model_name, object_pk, field_name))
+
+
+# connections inherited by forked workers; closing them would end the parent's sessions
+_inherited_connections = []
+
+
+def _render_with_retry(job, version_transform_data, original, max_attempts, retry_delay, forked):
+    """Process pool entry point; retries render_versions() with a growing delay"""
+    if forked:
+        # never talk over the socket of the parent's connection, nor close it
+        for conn in connections.all():
+            if conn.connection is not None:
+                _inherited_connections.append(conn.connection)
+                conn.connection = None
+    attempt = 1
+    while True:
+        try:
+            return render_versions(*job, version_transform_data=version_transform_data, original=original)
+        except Exception:
+            if attempt >= max_attempts:
+                raise
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+            attempt += 1
+
+
+class BaseVersionBackend(object):
+
+    def enqueue(self, instance, field, version_transform_data=None):
+        """Schedule the versions of `field` on a saved `instance` to be built"""
+        raise NotImplementedError
+
+    def is_pending(self, instance, field):
+        """Is there unfinished work for the versions of `field` on `instance`?"""
+        return False
+
+    def job_key(self, instance, field):
+        return (instance._meta.app_label, instance._meta.object_name, instance.pk, field.name)
+
+
+class ProcessPoolBackend(BaseVersionBackend):
+    """
+    Builds versions in a pool of local worker processes.
+
+    Jobs are queued from post_save, before the save is committed, so a worker
+    checks the row still holds the queued original and retries until it does.
+    Where Python supports it, workers are started by a fork server rather than
+    forked from the web process, so they inherit none of its database
+    connections or threads.
+
+    The pending state is kept in Django's cache, so use a cache shared between
+    web workers (memcached, redis...) for `ImageVersionSet.pending` to be accurate
+    across processes. Jobs that are still queued when the web process exits are lost.
+    """
+
+    def __init__(self, max_workers=None, max_attempts=None, retry_delay=None):
+        self.executor, self.forked = rendering.process_pool(max_workers or conf.DEFERRED_WORKERS)
+        self.max_attempts = max_attempts or conf.DEFERRED_MAX_ATTEMPTS
+        self.retry_delay = conf.DEFERRED_RETRY_DELAY if retry_delay is None else retry_delay
+
+    def _cache_key(self, job):
+        return 'awesome_imagefield:pending:%s.%s:%s:%s' % job
+
+    def enqueue(self, instance, field, version_transform_data=None):
+        job = self.job_key(instance, field)
+        cache_key = self._cache_key(job)
+        cache.set(cache_key, True, conf.DEFERRED_PENDING_TIMEOUT)
+
+        def done(future):
+            cache.delete(cache_key)
+            if future.exception() is not None:
+                logger.error("Building image versions failed for %s.%s(%s).%s: %r",
+                             *(job + (future.exception(),)))
+
+        future = self.executor.submit(_render_with_retry, job, version_transform_data, original_of(instance, field),
+                                      self.max_attempts, self.retry_delay, self.forked)
+        future.add_done_callback(done)
+        return future
+
+    def is_pending(self, instance, field):
+        return bool(cache.get(self._cache_key(self.job_key(instance, field))))
+
+
+class DatabaseBackend(BaseVersionBackend):
+    """
+    Stores jobs in the `VersionJob` table. Jobs are created in the same
+    transaction as the model save and are run by the `process_imageversion_jobs`
+    management command (cron, supervisor...).
+    """
+
+    def __init__(self, max_attempts=None, retry_delay=None):
+        self.max_attempts = max_attempts or conf.DEFERRED_MAX_ATTEMPTS
+        self.retry_delay = conf.DEFERRED_RETRY_DELAY if retry_delay is None else retry_delay
+
+    def _jobs(self, instance, field):
+        from .models import VersionJob
+        app_label, model_name, object_pk, field_name = self.job_key(instance, field)
+        return VersionJob.objects.filter(app_label=app_label, model_name=model_name,
+                                         object_pk=str(object_pk), field_name=field_name)
+
+    def enqueue(self, instance, field, version_transform_data=None):
+        from .models import VersionJob
+        # a newer job supersedes one that has not been started yet
+        self._jobs(instance, field).filter(status=VersionJob.PENDING).delete()
+        app_label, model_name, object_pk, field_name = self.job_key(instance, field)
+        return VersionJob.objects.create(
+            app_label=app_label,
+            model_name=model_name,
+            object_pk=str(object_pk),
+            field_name=field_name,
+            transform_data=json.dumps(version_transform_data) if version_transform_data else '',
+        )
+
+    def is_pending(self, instance, field):
+        from .models import VersionJob
+        return self._jobs(instance, field).filter(status__in=(VersionJob.PENDING, VersionJob.RUNNING)).exists()
+
+    def process(self, limit=None):
+        """Run the jobs which are due; returns the number of jobs processed"""
+        from .models import VersionJob
+        jobs = VersionJob.objects.filter(status=VersionJob.PENDING, run_after__lte=timezone.now())
+        if limit:
+            jobs = jobs[:limit]
+
+        processed = 0
+        for job in list(jobs):
+            # claim the job; another worker may have beaten us to it
+            claimed = VersionJob.objects.filter(pk=job.pk, status=VersionJob.PENDING).update(
+                status=VersionJob.RUNNING, attempts=F('attempts') + 1)
+            if not claimed:
+                continue
+            job.attempts += 1
+            try:
+                render_versions(job.app_label, job.model_name, job.object_pk, job.field_name,
+                                json.loads(job.transform_data) if job.transform_data else None)
+            except Exception:
+                logger.exception("Building image versions failed for %s", job)
+                if job.attempts >= self.max_attempts:
+                    job.status = VersionJob.FAILED
+                else:
+                    job.status = VersionJob.PENDING
+                    delay = self.retry_delay * 2 ** (job.attempts - 1)
+                    job.run_after = timezone.now() + timedelta(seconds=delay)
+                job.last_error = traceback.format_exc()
+                job.save()
+            else:
+                job.delete()
+            processed += 1
+        return processed
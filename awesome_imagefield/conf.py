@@ -0,0 +1,88 @@
+"""
+App settings. Each value can be overridden from the project's settings.py
+by prefixing its name with `AWESOME_IMAGEFIELD_`.
+"""
+from django.conf import settings
+
+
+# Backend that builds image versions for fields declared with `deferred=True`
+DEFERRED_BACKEND = getattr(settings, 'AWESOME_IMAGEFIELD_DEFERRED_BACKEND',
+                           'awesome_imagefield.backends.ProcessPoolBackend')
+
+# How many times a deferred job is tried before it is given up on
+DEFERRED_MAX_ATTEMPTS = getattr(settings, 'AWESOME_IMAGEFIELD_DEFERRED_MAX_ATTEMPTS', 3)
+
+# Seconds to wait before retrying a failed job; doubled on every attempt
+DEFERRED_RETRY_DELAY = getattr(settings, 'AWESOME_IMAGEFIELD_DEFERRED_RETRY_DELAY', 5)
+
+# Size of the process pool used by ProcessPoolBackend (None: one per core)
+DEFERRED_WORKERS = getattr(settings, 'AWESOME_IMAGEFIELD_DEFERRED_WORKERS', None)
+
+# How long ProcessPoolBackend reports a job as pending if it never finishes
+DEFERRED_PENDING_TIMEOUT = getattr(settings, 'AWESOME_IMAGEFIELD_DEFERRED_PENDING_TIMEOUT', 60 * 60)
+
+# How the crop branches of a save are rendered: 'serial', 'thread' or 'process'.
+# Pillow releases the GIL while resizing and encoding, so threads scale well.
+RENDER_EXECUTOR = getattr(settings, 'AWESOME_IMAGEFIELD_RENDER_EXECUTOR', 'serial')
+
+# Upper bound on the workers rendering versions at the same time (None: one per core)
+RENDER_MAX_WORKERS = getattr(settings, 'AWESOME_IMAGEFIELD_RENDER_MAX_WORKERS', None)
+
+# Originals are decoded at a reduced resolution (JPEG DCT scaling) when every
+# crop still has this many source pixels per output pixel. Higher values keep
+# more detail for the resize filter; None decodes at full resolution.
+DECODE_OVERSAMPLE = getattr(settings, 'AWESOME_IMAGEFIELD_DECODE_OVERSAMPLE', 2.0)
+
+# A version is only resized from a larger version (or a power of two reduction
+# of the crop) when that source has at least this many pixels per output pixel
+RESIZE_MIN_RATIO = getattr(settings, 'AWESOME_IMAGEFIELD_RESIZE_MIN_RATIO', 2.0)
+
+# Encoded versions are kept in memory up to this many bytes, then spooled to a temporary file
+SPOOL_MAX_SIZE = getattr(settings, 'AWESOME_IMAGEFIELD_SPOOL_MAX_SIZE', 2 * 1024 * 1024)
+
+# Seconds a lazily built version is locked for while it renders; concurrent
+# requests for it wait up to this long instead of rendering it again
+LAZY_LOCK_TIMEOUT = getattr(settings, 'AWESOME_IMAGEFIELD_LAZY_LOCK_TIMEOUT', 60)
+
+# Where pipeline timings are sent: a dotted path to a stats sink class such as
+# 'awesome_imagefield.stats.LoggingSink', 'awesome_imagefield.stats.StatsdSink'
+# or 'awesome_imagefield.stats.MemorySink'. None sends them nowhere.
+STATS_SINK = getattr(settings, 'AWESOME_IMAGEFIELD_STATS_SINK', None)
+
+# Address and metric prefix used by StatsdSink
+STATSD_HOST = getattr(settings, 'AWESOME_IMAGEFIELD_STATSD_HOST', 'localhost')
+STATSD_PORT = getattr(settings, 'AWESOME_IMAGEFIELD_STATSD_PORT', 8125)
+STATSD_PREFIX = getattr(settings, 'AWESOME_IMAGEFIELD_STATSD_PREFIX', 'awesome_imagefield')
+
+# Width of the downscaled copy of the original shown by the cropper widget
+PREVIEW_WIDTH = getattr(settings, 'AWESOME_IMAGEFIELD_PREVIEW_WIDTH', 900)
+
+# How long preview details are cached for rows without a version manifest
+PREVIEW_CACHE_TIMEOUT = getattr(settings, 'AWESOME_IMAGEFIELD_PREVIEW_CACHE_TIMEOUT', 60 * 60 * 24 * 30)
+
+# Where automatic crops are placed: 'awesome_imagefield.cropping.CenterCrop', or
+# 'awesome_imagefield.cropping.EnergyCrop' (needs NumPy) to follow the image's detail
+AUTO_CROP = getattr(settings, 'AWESOME_IMAGEFIELD_AUTO_CROP', 'awesome_imagefield.cropping.CenterCrop')
+
+# Uploads with more pixels or bytes than this are refused by the form field (None: no limit)
+MAX_PIXELS = getattr(settings, 'AWESOME_IMAGEFIELD_MAX_PIXELS', None)
+MAX_UPLOAD_SIZE = getattr(settings, 'AWESOME_IMAGEFIELD_MAX_UPLOAD_SIZE', None)
+
+# Decoded pixels held at once by the versions being built in a process; further
+# decodes wait for running ones to finish (None: no limit)
+DECODE_PIXEL_BUDGET = getattr(settings, 'AWESOME_IMAGEFIELD_DECODE_PIXEL_BUDGET', 100 * 1000 * 1000)
+
+# Threads writing versions to storage (and deleting them) side by side, shared
+# by every save in the process. 0 writes them one after another in the saving thread.
+STORAGE_IO_WORKERS = getattr(settings, 'AWESOME_IMAGEFIELD_STORAGE_IO_WORKERS', 8)
+
+# Seconds a fingerprinted version replaced by a save is kept, for pages and caches
+# still referring to it, before `collect_superseded_versions` may delete it
+SUPERSEDED_GRACE = getattr(settings, 'AWESOME_IMAGEFIELD_SUPERSEDED_GRACE', 60 * 60 * 24 * 7)
+
+# Directory of a local cache of originals kept on remote storage, so they are
+# not downloaded again for every re-crop or regeneration (None: no cache)
+ORIGINALS_CACHE_DIR = getattr(settings, 'AWESOME_IMAGEFIELD_ORIGINALS_CACHE_DIR', None)
+
+# Bytes the originals cache may use; the least recently used originals are evicted beyond that
+ORIGINALS_CACHE_SIZE = getattr(settings, 'AWESOME_IMAGEFIELD_ORIGINALS_CACHE_SIZE', 1024 * 1024 * 1024)
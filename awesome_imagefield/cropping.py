@@ -0,0 +1,112 @@
+"""
+Automatic crop strategies.
+
+Versions saved without crop data are cropped to the largest box of their
+aspect ratio that fits the original; the strategy named by the
+AWESOME_IMAGEFIELD_AUTO_CROP setting decides where that box goes. A strategy
+is called with the (possibly reduced) decoded original, the version's width
+and height and the (x, y) scale of the original to that image, and returns
+the box as a dict of x, y, x2, y2 in pixels of the original.
+"""
+from importlib import import_module
+
+from PIL import Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import conf
+
+_auto_crop = None
+
+
+def get_auto_crop():
+    """Return the (shared) instance of the configured auto crop strategy"""
+    global _auto_crop
+    if _auto_crop is None:
+        module_name, class_name = conf.AUTO_CROP.rsplit('.', 1)
+        _auto_crop = getattr(import_module(module_name), class_name)()
+    return _auto_crop
+
+
+def original_size(img, scale):
+    return int(round(img.size[0] * scale[0])), int(round(img.size[1] * scale[1]))
+
+
+def window_size(size, width, height):
+    """The largest (width, height) of the aspect ratio width:height that fits in `size`"""
+    aspect = width / float(height)
+    # for 4/3 aspect is 1.33333 etc
+    if size[0] / aspect <= size[1]:
+        # the image is taller than we need for this width
+        return size[0], size[0] / aspect
+    return size[1] * aspect, size[1]
+
+
+class CenterCrop(object):
+    """The crop box centered on the original"""
+
+    # strategies that look at the image are only called once it is decoded
+    needs_pixels = False
+
+    def __call__(self, img, width, height, scale=(1.0, 1.0)):
+        org_w, org_h = original_size(img, scale)
+        crop_w, crop_h = window_size((org_w, org_h), width, height)
+        return self.box(((org_w - crop_w) / 2, (org_h - crop_h) / 2), (crop_w, crop_h))
+
+    def box(self, offset, size):
+        return dict(
+            x=int(offset[0]),
+            y=int(offset[1]),
+            x2=int(size[0] + offset[0]),
+            y2=int(size[1] + offset[1]),
+        )
+
+
+class EnergyCrop(CenterCrop):
+    """
+    Places the crop box where the image is busiest. Edge energy is computed on
+    a copy of the image at most `analysis_size` pixels wide or high, and every
+    position of the box is scored at once from its integral image. Among boxes
+    scoring within `tolerance` of the best, the one closest to the center wins,
+    so flat images are still center cropped. Falls back to CenterCrop when
+    NumPy is not installed.
+    """
+    needs_pixels = True
+    analysis_size = 128
+    tolerance = 0.02
+
+    def __call__(self, img, width, height, scale=(1.0, 1.0)):
+        org_w, org_h = original_size(img, scale)
+        crop_w, crop_h = window_size((org_w, org_h), width, height)
+        if numpy is None or (int(crop_w), int(crop_h)) == (org_w, org_h):
+            return super(EnergyCrop, self).__call__(img, width, height, scale)
+
+        ratio = min(1.0, self.analysis_size / float(max(img.size)))
+        small_size = (max(1, int(round(img.size[0] * ratio))), max(1, int(round(img.size[1] * ratio))))
+        small = img.convert('L') if img.size == small_size else img.resize(small_size, Image.BOX).convert('L')
+        sx, sy = org_w / float(small_size[0]), org_h / float(small_size[1])
+        box_w = min(small_size[0], max(1, int(round(crop_w / sx))))
+        box_h = min(small_size[1], max(1, int(round(crop_h / sy))))
+
+        pixels = numpy.asarray(small, dtype=numpy.float32)
+        energy = numpy.zeros_like(pixels)
+        energy[:, 1:] += numpy.abs(numpy.diff(pixels, axis=1))
+        energy[1:, :] += numpy.abs(numpy.diff(pixels, axis=0))
+        integral = numpy.zeros((pixels.shape[0] + 1, pixels.shape[1] + 1), dtype=numpy.float64)
+        integral[1:, 1:] = energy.cumsum(axis=0).cumsum(axis=1)
+        # scores[y, x] is the energy of the box with its top left corner at (x, y)
+        scores = (integral[box_h:, box_w:] - integral[:-box_h, box_w:] -
+                  integral[box_h:, :-box_w] + integral[:-box_h, :-box_w])
+
+        best = scores.max()
+        if best <= 0:
+            return super(EnergyCrop, self).__call__(img, width, height, scale)
+        ys, xs = numpy.nonzero(scores >= best * (1 - self.tolerance))
+        center_x, center_y = (scores.shape[1] - 1) / 2.0, (scores.shape[0] - 1) / 2.0
+        closest = numpy.argmin(numpy.abs(xs - center_x) + numpy.abs(ys - center_y))
+        x = min(max(0, xs[closest] * sx), org_w - crop_w)
+        y = min(max(0, ys[closest] * sy), org_h - crop_h)
+        return self.box((x, y), (crop_w, crop_h))
@@ -1,12 +1,20 @@
+import hashlib
+import json
 import os.path
+import time
 from PIL import Image
-import StringIO
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.db.models.fields.files import ImageFileDescriptor
+from django.db.models import signals
+from django.core.urlresolvers import reverse
+from django.core.files.images import get_image_dimensions
+from django.db.models.fields.files import ImageFileDescriptor, ImageFieldFile
 
 from south.modelsinspector import add_introspection_rules
+from . import conf, cropping, limits, originals, planning, rendering, specs, stats, streaming, superseded
 from .form.fields import VersionedImageField as CropperFormField
 
 
@@ -15,6 +23,27 @@ add_introspection_rules([], ["^awesome_imagefield\.fields\.VersionedImageField"]
 add_introspection_rules([], ["^awesome_imagefield\.fields\.SquareAutoCropVersionedImageField"])
 
 
+class LazyVersionFieldFile(ImageFieldFile):
+    """
+    A version which has not been built yet. Its url points to a view which
+    builds it on the first request and redirects to the real file.
+    """
+
+    def __init__(self, instance, field, name, version_id):
+        super(LazyVersionFieldFile, self).__init__(instance, field, name)
+        self.version_id = version_id
+
+    @property
+    def url(self):
+        return reverse('awesome_imagefield_version', kwargs={
+            'app_label': self.instance._meta.app_label,
+            'model_name': self.instance._meta.object_name,
+            'object_pk': self.instance.pk,
+            'field_name': self.field.name,
+            'version_id': self.version_id,
+        })
+
+
 class ImageVersionSet(object):
 
     def __init__(self, field, model_instance, filename):
@@ -22,37 +51,92 @@ class ImageVersionSet(object):
         self.filename = filename
         self.model_instance = model_instance
 
-        '''
-        To get a set of ALL image versions which can be accessed from
-        templates, append the collection of `autosize_versions` from models to
-        existing image versions.
-        '''
-        # Copy existing versions, find their 'autosize_versions' (if any), and
-        # copy those to the top level of versions. To avoid recursion
-        # problems, start with an empty dict and copy elements in.
-        flat_versions = {}
-        for version, attribs in field.versions.items():
-            if 'autosize_versions' in attribs:
-                flat_versions.update(attribs['autosize_versions'])
-            flat_versions[version] = attribs
-
-        self._versions = flat_versions
+        # ALL image versions, `autosize_versions` included, can be accessed
+        # from templates; the field's compiled table is shared, not copied
+        self._versions = field.flat_versions
+        # storage.exists() answers by file path, filled in bulk by prefetch_versions()
+        self._exists = {}
 
     def __getattr__(self, name):
 
         try:
-            filepath = self._versions[name]['upload_to'](self.model_instance, self.filename)
+            filepath = self.field.version_filename(self._versions[name], self.model_instance, self.filename)
 
         except (AttributeError, LookupError):
             return None
 
-        if filepath and self.field.storage.exists(filepath):
+        manifest = self.field.get_manifest(self.model_instance, self.filename)
+        entry = manifest['versions'].get(name) if manifest is not None else None
+        if manifest is not None and not entry and manifest.get('original_hash'):
+            # the manifest of an upload lists all of its versions
+            return self._lazy_version(name, filepath)
+        if entry:
+            # answer from the manifest without a storage round trip
+            field_file_object = self.field.attr_class(self.model_instance, self.field, entry['name'])
+            field_file_object._dimensions_cache = (entry['width'], entry['height'])
+            alternates = [(alternate_format, alternate['name'])
+                          for alternate_format, alternate in sorted(entry.get('alternates', {}).items())]
+        elif filepath and self._file_exists(filepath):
             field_file_object = self.field.attr_class(self.model_instance, self.field, filepath)
+            # built along with the version, so not checked separately
+            alternates = [(alternate_format, rendering.with_extension(filepath, alternate_format))
+                          for alternate_format, _ in self.field.encoders[name][1:]]
         else:
-            return None
+            return self._lazy_version(name, filepath)
 
+        field_file_object.alternates = self._alternate_files(alternates)
         return field_file_object
 
+    def _file_exists(self, filepath):
+        if filepath not in self._exists:
+            self._exists[filepath] = self.field.storage.exists(filepath)
+        return self._exists[filepath]
+
+    def _alternate_files(self, alternates):
+        """
+        Files of the extra formats of a version, for <picture> sources:
+            {% for source in object.file.versions.large_3_2.alternates %}
+                <source srcset="{{ source.url }}" type="{{ source.content_type }}">
+            {% endfor %}
+        """
+        files = []
+        for alternate_format, name in alternates:
+            field_file_object = self.field.attr_class(self.model_instance, self.field, name)
+            field_file_object.format = alternate_format
+            field_file_object.content_type = rendering.content_type(alternate_format)
+            files.append(field_file_object)
+        return files
+
+    def _lazy_version(self, name, filepath):
+        """A missing version; built on first request for `lazy` fields"""
+        if not (self.field.lazy and filepath and self.model_instance is not None and self.model_instance.pk):
+            return None
+        return LazyVersionFieldFile(self.model_instance, self.field, filepath, name)
+
+    @property
+    def pending(self):
+        """True while a deferred backend still has to build this instance's versions"""
+        if not (self.field.deferred and self.model_instance is not None and self.model_instance.pk):
+            return False
+        from .backends import get_backend
+        return get_backend().is_pending(self.model_instance, self.field)
+
+
+class VersionedImageFieldFile(ImageFieldFile):
+
+    def _get_image_dimensions(self):
+        # originals (which have versions) answer from what was captured at upload,
+        # else from the originals cache when it's enabled
+        if not hasattr(self, '_dimensions_cache') and self._file is None and getattr(self, 'versions', None):
+            info = self.field.original_info(self.instance, self.name)
+            if info is not None:
+                self._dimensions_cache = (info['width'], info['height'])
+            else:
+                cached = originals.open_original(self.storage, self.name)
+                if cached is not None:
+                    self._dimensions_cache = get_image_dimensions(cached, close=True)
+        return super(VersionedImageFieldFile, self)._get_image_dimensions()
+
 
 class VersionedImageFileDescriptor(ImageFileDescriptor):
 
@@ -64,11 +148,31 @@ class VersionedImageFileDescriptor(ImageFileDescriptor):
 
 
 class BaseVersionedImageField(models.ImageField):
+    attr_class = VersionedImageFieldFile
     descriptor_class = VersionedImageFileDescriptor
 
-    def __init__(self, versions=None, upload_to='', use_field_name_as_file_name=False, *args, **kwargs):
+    def __init__(self, versions=None, upload_to='', use_field_name_as_file_name=False, deferred=False,
+                 manifest_field=None, lazy=False, fingerprint=False, format_field=None, mode_field=None,
+                 orientation_field=None, filesize_field=None, *args, **kwargs):
         self.versions = versions
+        # Name of a TextField on the model which records the generated versions.
+        # It has to be declared after this field so pre_save() runs first;
+        # checked once the model is prepared, see check_manifest_field().
+        self.manifest_field = manifest_field
         self.use_field_name_as_file_name = use_field_name_as_file_name
+        # Only commit the original in pre_save() and let a backend build the versions later
+        self.deferred = deferred
+        # Build versions which are not cropped by hand on first access instead of in pre_save()
+        self.lazy = lazy
+        # Put a hash of their content in version filenames, so every file is immutable
+        # and can be cached forever; the current names live in the manifest
+        self.fingerprint = fingerprint
+        # Like `width_field` and `height_field`: model fields filled with the format,
+        # mode, EXIF orientation and byte size of an original when it's uploaded
+        self.format_field = format_field
+        self.mode_field = mode_field
+        self.orientation_field = orientation_field
+        self.filesize_field = filesize_field
 
         # In order to use the field name as the file name, we need to change how `upload_to` is used
         # We save it for use later in our custom generate_filename(); do not pass into parent constructor
@@ -82,6 +186,37 @@ class BaseVersionedImageField(models.ImageField):
 
         return super(BaseVersionedImageField, self).__init__(upload_to=upload_to, *args, **kwargs)
 
+    def contribute_to_class(self, cls, name):
+        super(BaseVersionedImageField, self).contribute_to_class(cls, name)
+        self.compile_versions('%s.%s' % (cls.__name__, name))
+        if self.manifest_field:
+            # the model's other fields are only all there once it is prepared
+            signals.class_prepared.connect(self.check_manifest_field, sender=cls, weak=False)
+        if self.fingerprint:
+            if not self.manifest_field:
+                raise ImproperlyConfigured("%s.%s: fingerprint=True needs a manifest_field" % (cls.__name__, name))
+            if 'awesome_imagefield' not in settings.INSTALLED_APPS:
+                raise ImproperlyConfigured("%s.%s: fingerprint=True needs 'awesome_imagefield' in INSTALLED_APPS"
+                                           % (cls.__name__, name))
+            # files replaced by this save are recorded for deletion with it
+            signals.post_save.connect(self.collect_superseded_versions, sender=cls)
+        if self.deferred:
+            # versions are handed off once the instance has a primary key
+            signals.post_save.connect(self.enqueue_deferred_versions, sender=cls)
+
+    def check_manifest_field(self, sender, **kwargs):
+        """
+        The manifest is filled in by pre_save(), which Django calls in field
+        order: a manifest field declared before this one would be saved stale.
+        """
+        names = [field.name for field in sender._meta.local_fields]
+        if self.manifest_field not in names:
+            raise ImproperlyConfigured("%s.%s: manifest_field %r is not a field of the model"
+                                       % (sender.__name__, self.name, self.manifest_field))
+        if names.index(self.manifest_field) < names.index(self.name):
+            raise ImproperlyConfigured("%s.%s: manifest_field %r has to be declared after the image field"
+                                       % (sender.__name__, self.name, self.manifest_field))
+
     def pre_save(self, model_instance, add):
         """
         Skip parent pre_save()s because we want to delete the file before save()
@@ -101,14 +236,355 @@ class BaseVersionedImageField(models.ImageField):
             # filename is created in FieldFile.save() so we need to replicate what it will be
             on_disk_filename = self.generate_filename(model_instance, file.name)
 
-            # now delete the file that we expect to save
-            self.storage.delete(on_disk_filename)
+            # now delete the file that we expect to save, while the upload is hashed
+            batch = streaming.WriteBatch(self.storage)
+            batch.delete(on_disk_filename)
+            if hasattr(self, 'preview_filename'):
+                # the cropper's preview of the previous original goes with it
+                batch.delete(self.preview_filename(on_disk_filename))
+                cache.delete(self._preview_cache_key(on_disk_filename))
+            original_hash = self.hash_original(file) if self.manifest_field else None
+            info = self.capture_original_info(model_instance, file)
+            batch.wait()
 
             # Commit the file to storage prior to saving the model.
             # Normally happens in django.db.models.fields.files.py->FileField.pre_save()
+            # (the captured details already go by the name it is saved as)
+            if info is not None:
+                self._cache_original_info(model_instance, on_disk_filename, info)
             file.save(file.name, file, save=False)
+            if info is not None and file.name != on_disk_filename:
+                self._cache_original_info(model_instance, file.name, info)
+            originals.remember(self.storage, file.name, file)
+
+            if self.lazy:
+                # versions of the previous original would otherwise never be rebuilt
+                self.forget_versions(model_instance, file, original_hash)
+            elif self.manifest_field:
+                manifest = self.get_manifest(model_instance, file.name)
+                if manifest is None or manifest.get('original_hash') != original_hash:
+                    # a different original; none of the recorded versions are current
+                    self.reset_manifest(model_instance, file.name, original_hash)
+            if self.manifest_field:
+                manifest = self.get_manifest(model_instance, file.name)
+                manifest.pop('preview', None)
+                if info is not None:
+                    manifest['image'] = info
+                self._set_manifest(model_instance, manifest)
         return file
 
+    def update_dimension_fields(self, instance, force=False, *args, **kwargs):
+        """
+        Fill the companion fields of a newly assigned original from its header
+        (see capture_original_info()); Django would open it again for
+        `width_field` and `height_field`, and for originals already in storage.
+        """
+        file = getattr(instance, self.attname)
+        if file and (force or not file._committed):
+            if not file._committed:
+                info = self.capture_original_info(instance, file)
+            else:
+                # the width and height fields still describe the previous original
+                info = self.original_info(instance, file.name, use_fields=False)
+            if info is not None:
+                file._dimensions_cache = (info['width'], info['height'])
+        return super(BaseVersionedImageField, self).update_dimension_fields(instance, force, *args, **kwargs)
+
+    def capture_original_info(self, instance, file):
+        """
+        Read the width, height, format, mode, EXIF orientation and byte size of
+        an uploaded original from its header, once; keep them for dimension
+        reads and in the companion fields. Returns them as a dict, or None
+        when the file is not an image.
+        """
+        cached = instance.__dict__.get('_imageversion_originals', {}).get(self.name)
+        if cached is not None and cached[0] == file.name:
+            info = cached[1]
+        else:
+            try:
+                info = limits.probe(file)
+            except Exception:
+                # left to validation, like Django does for dimensions
+                return None
+            self._cache_original_info(instance, file.name, info)
+        for key, attname in (('format', self.format_field), ('mode', self.mode_field),
+                             ('orientation', self.orientation_field), ('size', self.filesize_field)):
+            if attname:
+                setattr(instance, attname, info[key])
+        return info
+
+    def _cache_original_info(self, instance, filename, info):
+        instance.__dict__.setdefault('_imageversion_originals', {})[self.name] = (filename, info)
+
+    def original_info(self, instance, filename, use_fields=True):
+        """
+        What was captured about the original `filename` when it was uploaded:
+        from this instance, its manifest, or its `width_field` and `height_field`.
+        None when there is nothing, and the original has to be opened.
+        """
+        if instance is None:
+            return None
+        cached = instance.__dict__.get('_imageversion_originals', {}).get(self.name)
+        if cached is not None and cached[0] == filename:
+            return cached[1]
+        manifest = self.get_manifest(instance, filename)
+        if manifest is not None and 'image' in manifest:
+            return manifest['image']
+        if use_fields and self.width_field and self.height_field:
+            width, height = getattr(instance, self.width_field), getattr(instance, self.height_field)
+            if width and height:
+                return {'width': width, 'height': height}
+        return None
+
+    def hash_original(self, file):
+        """Hash of the bytes of an uploaded original"""
+        digest = hashlib.sha1()
+        for chunk in file.chunks():
+            digest.update(chunk)
+        file.seek(0)
+        return digest.hexdigest()
+
+    def version_digest(self, original_hash, crop, version_id):
+        """
+        Fingerprint of everything a version is built from: the original's bytes,
+        its crop box and its spec. A version whose digest is unchanged needs no rebuild.
+        """
+        box = [crop['x'], crop['y'], crop['x2'], crop['y2']] if crop else None
+        key = json.dumps([original_hash, box, self.flat_versions[version_id].digest])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def forget_versions(self, model_instance, file, original_hash=None):
+        """Delete every version of `file` and empty the manifest"""
+        batch = streaming.WriteBatch(self.storage)
+        # fingerprinted versions are collected from the manifest by reset_manifest()
+        for version_id, version in (self.flat_versions.items() if not self.fingerprint else ()):
+            name = self.version_filename(version, model_instance, file.name)
+            batch.delete(name)
+            for alternate_format, _ in self.encoders[version_id][1:]:
+                batch.delete(rendering.with_extension(name, alternate_format))
+        if hasattr(self, 'preview_filename'):
+            batch.delete(self.preview_filename(file.name))
+        batch.wait()
+        self.reset_manifest(model_instance, file.name, original_hash)
+
+    def defer_versions(self, model_instance, version_transform_data=None):
+        """Remember the crop data until the instance is saved, see enqueue_deferred_versions()"""
+        pending = model_instance.__dict__.setdefault('_deferred_imageversions', {})
+        pending[self.name] = version_transform_data
+
+    def enqueue_deferred_versions(self, instance, raw=False, **kwargs):
+        pending = instance.__dict__.get('_deferred_imageversions', {})
+        if raw or self.name not in pending:
+            return
+        from .backends import get_backend
+        get_backend().enqueue(instance, self, pending.pop(self.name))
+
+    def compile_versions(self, name='field'):
+        """
+        Check `versions` and compile them, once per field definition, into
+        specs.VersionSpecs. Bad configs raise ImproperlyConfigured at startup.
+        """
+        self.specs = specs.compile_versions(self.versions, name)
+        # every version, including `autosize_versions`, by id
+        self.flat_versions = self.specs.flat
+        # kept as plain data, it's handed to rendering processes
+        self.encoders = dict((version_id, spec.encoders) for version_id, spec in self.flat_versions.items())
+        self.resize_plans = self.plan_resizes()
+
+    def plan_resizes(self):
+        """How every crop version and its `autosize_versions` are resized: {version_id: resize plan}"""
+        return self.specs.plans
+
+    def generate_versions(self, model_instance, file, version_transform_data=None, only=None):
+        """
+        Build and save the image versions of `file`, or only those whose ids
+        are in `only`. Returns {version_id: bytes written}.
+        """
+        raise NotImplementedError
+
+    def stale_versions(self, instance):
+        """
+        Ids of the versions of `instance` which are missing from storage or
+        were built from an older version spec. Versions the manifest doesn't
+        list are checked in storage when the row predates the manifest.
+        """
+        file = getattr(instance, self.attname)
+        if not file:
+            return set()
+        manifest = self.get_manifest(instance, file.name)
+        stale = set()
+        for version_id, version in self.flat_versions.items():
+            entry = manifest['versions'].get(version_id) if manifest is not None else None
+            if entry:
+                if entry.get('spec') != version.digest or not self.storage.exists(entry['name']):
+                    stale.add(version_id)
+            elif manifest is not None and manifest.get('original_hash'):
+                stale.add(version_id)
+            elif not self.storage.exists(self.version_filename(version, instance, file.name)):
+                stale.add(version_id)
+        return stale
+
+    def regenerate_versions(self, instance, version_ids):
+        """Rebuild the versions in `version_ids` using the crops they were last built with"""
+        return self.generate_versions(instance, getattr(instance, self.attname), only=set(version_ids))
+
+    def get_manifest(self, instance, filename):
+        """
+        The parsed version manifest of `instance`, or None when the field has
+        no manifest or the row predates it (or a different original).
+        """
+        manifest = self._parsed_manifest(instance)
+        if manifest is None or manifest.get('original') != filename:
+            return None
+        return manifest
+
+    def _parsed_manifest(self, instance):
+        """The manifest of `instance`, whichever original it is for"""
+        if not self.manifest_field or instance is None:
+            return None
+        raw = getattr(instance, self.manifest_field)
+        if not raw:
+            return None
+        # parse every raw value only once
+        parsed = instance.__dict__.setdefault('_imageversion_manifests', {})
+        if self.name not in parsed or parsed[self.name][0] is not raw:
+            parsed[self.name] = (raw, json.loads(raw))
+        return parsed[self.name][1]
+
+    def record_version(self, instance, filename, version_id, entry):
+        """Add (or replace) the manifest entry of a version"""
+        if not self.manifest_field:
+            return
+        manifest = self.get_manifest(instance, filename)
+        if manifest is None:
+            manifest = self._seeded_manifest(instance, filename)
+        if self.fingerprint and version_id in manifest['versions']:
+            self._supersede(instance, self._recorded_names([manifest['versions'][version_id]]))
+        manifest['versions'][version_id] = entry
+        self._set_manifest(instance, manifest)
+
+    def _seeded_manifest(self, instance, filename):
+        """
+        A new manifest for a row saved before it had one, listing every version
+        of `filename` already in storage; versions it left out would be taken
+        for missing ones.
+        """
+        manifest = {'original': filename, 'versions': {}}
+        for version_id, version in self.flat_versions.items():
+            name = self.version_filename(version, instance, filename)
+            if self.storage.exists(name):
+                manifest['versions'][version_id] = self._existing_entry(version_id, name)
+        return manifest
+
+    def _existing_entry(self, version_id, name):
+        """Manifest entry of a version built before the manifest existed"""
+        spec = self.flat_versions[version_id]
+        return {
+            'name': name,
+            'width': spec.width,
+            'height': spec.height,
+            'size': None,
+            'generated': None,
+            # assume legacy files were built from the current spec
+            'spec': spec.digest,
+        }
+
+    def _set_manifest(self, instance, manifest):
+        raw = json.dumps(manifest, sort_keys=True, separators=(',', ':'))
+        setattr(instance, self.manifest_field, raw)
+        instance.__dict__.setdefault('_imageversion_manifests', {})[self.name] = (raw, manifest)
+
+    def reset_manifest(self, instance, filename, original_hash=None):
+        """Start an empty manifest for a newly uploaded original"""
+        if not self.manifest_field:
+            return
+        previous = self._parsed_manifest(instance)
+        if self.fingerprint and previous is not None:
+            self._supersede(instance, self._recorded_names(previous['versions'].values()))
+        manifest = {'original': filename, 'versions': {}}
+        if original_hash:
+            manifest['original_hash'] = original_hash
+        self._set_manifest(instance, manifest)
+
+    def _recorded_names(self, entries):
+        """Storage names of the files of manifest `entries`, alternates included"""
+        names = set()
+        for entry in entries:
+            names.add(entry['name'])
+            names.update(alternate['name'] for alternate in entry.get('alternates', {}).values())
+        return names
+
+    def _supersede(self, instance, names):
+        """Have the files `names` collected once the instance is saved, see collect_superseded_versions()"""
+        pending = instance.__dict__.setdefault('_superseded_imageversions', {})
+        pending.setdefault(self.name, set()).update(names)
+
+    def collect_superseded_versions(self, instance, raw=False, **kwargs):
+        """
+        Record the fingerprinted files which the saved manifest no longer refers
+        to for deletion, in the save's transaction; see awesome_imagefield.superseded.
+        """
+        names = instance.__dict__.get('_superseded_imageversions', {}).pop(self.name, None)
+        if raw or not names:
+            return
+        manifest = self._parsed_manifest(instance)
+        if manifest is not None:
+            # a crop may have gone back to an earlier file
+            names -= self._recorded_names(manifest['versions'].values())
+        if names:
+            superseded.supersede(instance, self, names)
+
+    def _reject_manifest(self, instance, expected):
+        """
+        The manifest of `instance` wasn't saved over `expected`: the files it
+        would have replaced are still current, and the ones it added are recorded
+        nowhere, so have them collected.
+        """
+        instance.__dict__.get('_superseded_imageversions', {}).pop(self.name, None)
+        manifest = self._parsed_manifest(instance)
+        if manifest is None:
+            return
+        added = self._recorded_names(manifest['versions'].values())
+        if expected:
+            added -= self._recorded_names(json.loads(expected)['versions'].values())
+        if added:
+            superseded.supersede(instance, self, added)
+
+    def save_manifest(self, instance, expected=None):
+        """
+        Write the manifest of an already saved instance to the database. With
+        `expected`, the raw manifest the instance was loaded with, it's only
+        written if the row still holds that. Returns whether it was written.
+        """
+        if not self.manifest_field:
+            return True
+        rows = type(instance)._default_manager.filter(pk=instance.pk)
+        if expected is not None:
+            rows = rows.filter(**{self.manifest_field: expected})
+        if not rows.update(**{self.manifest_field: getattr(instance, self.manifest_field)}):
+            if self.fingerprint:
+                self._reject_manifest(instance, expected)
+            return False
+        if self.fingerprint:
+            self.collect_superseded_versions(instance)
+        return True
+
+    def open_original(self, file):
+        """
+        The original of `file` as an unloaded PIL image: from the upload itself
+        on new uploads, else from the local originals cache when it's enabled,
+        else from storage.
+        """
+        if file._file is None:
+            cached = originals.open_original(self.storage, file.name)
+            if cached is not None:
+                return Image.open(cached)
+        try:
+            return Image.open(file)
+        except:
+            file.open()  # reopen which sets Django's File-like object to seek=0
+            return Image.open(file)
+
     def get_filename(self, filename):
         # Set the name of the Field as the filename but keep original extension
         custom_name = "%s%s" % (self.name, os.path.splitext(filename)[1]) if self.use_field_name_as_file_name else None
@@ -122,54 +598,141 @@ class BaseVersionedImageField(models.ImageField):
             return self._upload_to(instance, custom_name)
         return super(BaseVersionedImageField, self).generate_filename(instance, custom_name)
 
-    def gen_auto_crop_version(self, version, img):
+    def gen_auto_crop_version(self, version, img, scale=None):
         #returns the bounding box in the form of (x,y,x1,y1) where x and y are the
-        # upper left and x1 and y1 are the lower right.
-        aspect = version['width'] / float(version['height'])
-        # for 4/3 aspect is 1.33333 etc
-        width = img.size[0]
-        height = img.size[1]
-        # if the image is taller than we need for this width
-        if (width / aspect <= height):
-            crop_width = width
-            crop_height = width / aspect
-            offset = (0, (height - crop_height)/2)
-        # the image is too short
-        elif(height * aspect < width):
-            crop_height = height
-            crop_width = height * aspect
-            offset = ((width - crop_width)/2, 0)
-        else:
-            raise Exception("you should never be here, the image is probably too small")
-        out = dict(
-            x=int(offset[0]),
-            y=int(offset[1]),
-            x2=int(crop_width + offset[0]),
-            y2=int(crop_height + offset[1]),
-        )
-        return out
-
-    def _file_save(self, new_pil_obj, version, format, model_instance, file):
-        """Save our version files to disk"""
-
-        img_version_buffer = StringIO.StringIO()
-        new_pil_obj.save(img_version_buffer, format)
-
-        img_version_buffer = InMemoryUploadedFile(
-            file=img_version_buffer,
-            field_name=None,
-            name='foo',
-            content_type='image/%s' % format,
-            size=img_version_buffer.len,
-            charset=None)
-        img_version_buffer.open()  # reopen just in case, which sets Django's File-like object to seek=0
-
-        filename = version['upload_to'](model_instance, file.name)
-
-        # delete first to prevent save() from possibily creating a new uniquely named file
-        # we want to replace the file, which save() may not do natively
-        file.field.storage.delete(filename)
-        file.field.storage.save(filename, img_version_buffer)
+        # upper left and x1 and y1 are the lower right, in pixels of the original.
+        # `img` may be decoded at a reduced `scale`; until it is decoded (no scale)
+        # strategies which look at the pixels give way to the centered box, which
+        # has the same size.
+        auto_crop = cropping.get_auto_crop()
+        if scale is None:
+            if auto_crop.needs_pixels:
+                auto_crop = cropping.CenterCrop()
+            scale = (1.0, 1.0)
+        return auto_crop(img, version['width'], version['height'], scale)
+
+    def version_filename(self, version, model_instance, filename):
+        """Storage name of a version; versions stored in another format get its extension"""
+        name = version['upload_to'](model_instance, filename)
+        if version.get('format'):
+            name = rendering.with_extension(name, version['format'])
+        return name
+
+    def _store_rendered(self, model_instance, file, branches, format, only, recorder, crops, digest):
+        """
+        Render the (img, steps) `branches` and queue every version in `only`
+        (all of them when None) for storage as soon as it is rendered; crop
+        versions are recorded with their box from `crops`, and every version
+        with `digest(version_id)`. If rendering fails, the writes are rolled
+        back. Returns a function which waits for the writes to finish, records
+        them and returns {version_id: bytes written}; call it once the decoded
+        original is no longer needed.
+        """
+        batch = streaming.WriteBatch(self.storage)
+        written = {}
+        stored = []
+        try:
+            with recorder.stage('render'):
+                for version_id, encoded, size, timings in rendering.iter_rendered(branches, format, self.encoders):
+                    if only is not None and version_id not in only:
+                        # only rendered as the source of another version
+                        for _, content in encoded:
+                            if hasattr(content, 'close'):
+                                content.close()
+                        continue
+                    written[version_id] = self._encoded_file_save(
+                        encoded[0][1], self.flat_versions[version_id], model_instance, file, version_id, size,
+                        crops.get(version_id), digest(version_id), encoded[1:], batch, timings)
+                    stored.append((version_id, timings, size))
+        except:
+            batch.rollback()
+            raise
+
+        def done():
+            with recorder.stage('store'):
+                batch.wait()
+            for version_id, timings, size in stored:
+                recorder.version(version_id, timings, size[0] * size[1], written[version_id])
+            recorder.finish()
+            return written
+        return done
+
+    def _encoded_file_save(self, content, version, model_instance, file, version_id=None, size=None,
+                           crop=None, digest=None, alternates=(), batch=None, timings=None):
+        """
+        Save an already encoded version (a file or bytes) and its `alternates`,
+        a list of (format, encoded), to disk. Returns the bytes written.
+
+        With a streaming.WriteBatch the files are only queued on it, and recorded
+        in the manifest when the caller's batch.wait() finds they were all written.
+        """
+        own_batch = batch is None
+        if own_batch:
+            batch = streaming.WriteBatch(self.storage)
+        filename = self.version_filename(version, model_instance, file.name)
+        names = [(None, self._output_name(filename, content), content)]
+        for alternate_format, alternate in alternates:
+            name = rendering.with_extension(filename, alternate_format)
+            names.append((alternate_format, self._output_name(name, alternate), alternate))
+        # fingerprinted names never hold other content, so there is nothing to delete
+        # first, and a file which is already recorded needs no writing at all
+        current = set()
+        manifest = self.get_manifest(model_instance, file.name)
+        if self.fingerprint and manifest is not None and version_id in manifest['versions']:
+            current = self._recorded_names([manifest['versions'][version_id]])
+        names = [(output_format, name, batch.keep(name, output) if name in current
+                  else batch.replace(name, output, overwrite=not self.fingerprint))
+                 for output_format, name, output in names]
+        batch.then(lambda: self._record_stored(
+            batch, names, version, model_instance, file, version_id, size, crop, digest, timings))
+        if own_batch:
+            batch.wait()
+        return sum(nbytes for _, _, nbytes in names)
+
+    def _record_stored(self, batch, names, version, model_instance, file, version_id, size, crop, digest, timings):
+        filename, seconds = batch.stored[names[0][1]]
+        nbytes = names[0][2]
+        stored_alternates = {}
+        for alternate_format, name, size_written in names[1:]:
+            stored_alternates[alternate_format] = {'name': batch.stored[name][0], 'size': size_written}
+            seconds += batch.stored[name][1]
+        if timings is not None:
+            timings['store'] = seconds
+
+        if version_id is not None:
+            width, height = size or (version['width'], version['height'])
+            entry = {
+                'name': filename,
+                'width': width,
+                'height': height,
+                'size': nbytes,
+                'generated': int(time.time()),
+                'spec': self.flat_versions[version_id].digest,
+            }
+            if crop is not None:
+                entry['crop'] = crop
+            if digest is not None:
+                entry['digest'] = digest
+            if stored_alternates:
+                entry['alternates'] = stored_alternates
+            self.record_version(model_instance, file.name, version_id, entry)
+
+    def _output_name(self, name, content):
+        if self.fingerprint:
+            return streaming.fingerprinted(name, content)
+        return name
+
+    def _store(self, content, filename):
+        """Write encoded content to storage, returns the stored name and its byte size"""
+        content = streaming.as_file(content)
+        nbytes = streaming.size_of(content)
+        # replace the file in a single step where the storage allows it,
+        # save() alone may create a new uniquely named file instead
+        try:
+            filename = streaming.replace(self.storage, filename, content)
+        finally:
+            content.close()
+        return filename, nbytes
 
 
 class VersionedImageField(BaseVersionedImageField):
@@ -191,74 +754,325 @@ class VersionedImageField(BaseVersionedImageField):
 
         file = super(VersionedImageField, self).pre_save(model_instance, add)
         if file:
-            try:
-                img_pil_org = Image.open(file)
-            except:
-                file.open()  # reopen which sets Django's File-like object to seek=0
-                img_pil_org = Image.open(file)
-
-            if not hasattr(file, 'version_transform_data'):
-                # check if a image version already exists
-                vt_data = dict()
-                for version_id, version_data in file.field.versions.items():
+            version_transform_data = getattr(file, 'version_transform_data', None)
+            if version_transform_data is not None:
+                delattr(file, 'version_transform_data')
+            elif self.lazy:
+                # auto cropped versions are built on first access
+                return file
+
+            crops, changed = self.changed_versions(model_instance, file, version_transform_data)
+            if changed is not None and not changed:
+                # nothing the versions are built from changed; skip decoding altogether
+                return file
+
+            if self.deferred:
+                self.defer_versions(model_instance, version_transform_data)
+            elif changed is None:
+                self.generate_versions(model_instance, file, version_transform_data)
+            else:
+                self.generate_versions(model_instance, file, crops, only=changed)
+        return file
+
+    def preview_filename(self, filename):
+        """Storage name of the cropper's preview of an original"""
+        directory, name = os.path.split(filename)
+        return os.path.join(directory, 'preview', name)
+
+    def preview_size(self, original_size):
+        width, height = original_size
+        if width <= conf.PREVIEW_WIDTH:
+            return original_size
+        return conf.PREVIEW_WIDTH, max(1, int(round(height * conf.PREVIEW_WIDTH / float(width))))
+
+    def get_preview(self, instance, file):
+        """
+        The downscaled copy of the original shown by the cropper widget, built
+        once per original. Returns (preview file, (x scale, y scale) from original
+        to preview pixels, (original width, original height)).
+        """
+        info = None
+        manifest = self.get_manifest(instance, file.name)
+        if manifest is not None:
+            info = manifest.get('preview')
+        if info is None:
+            info = cache.get(self._preview_cache_key(file.name))
+        if info is None:
+            loaded = getattr(instance, self.manifest_field) if manifest is not None else None
+            info = self.build_preview(instance, file)
+            if manifest is not None and instance.pk:
+                # versions recorded since the instance was loaded win; the
+                # details stay in the cache, which build_preview() filled
+                self.save_manifest(instance, expected=loaded)
+        preview = self.attr_class(instance, self, info['name'])
+        preview._dimensions_cache = (info['width'], info['height'])
+        scale = (info['width'] / float(info['original_width']), info['height'] / float(info['original_height']))
+        return preview, scale, (info['original_width'], info['original_height'])
+
+    def build_preview(self, instance, file, img=None, scale=(1.0, 1.0)):
+        """
+        Save the preview of `file`, made from `img` when the original is
+        already open (decoded at `scale`, as returned by planning.reduced_decode()).
+        """
+        if img is None:
+            img = self.open_original(file)
+            factor = planning.decode_reduction(
+                [((0, 0) + img.size, self.preview_size(img.size))], conf.DECODE_OVERSAMPLE)
+            with limits.decoding(planning.decoded_size(img, factor)):
+                img, scale = planning.reduced_decode(img, factor)
+                return self.build_preview(instance, file, img, scale)
+        original_size = (int(round(img.size[0] * scale[0])), int(round(img.size[1] * scale[1])))
+        size = self.preview_size(original_size)
+        if size == original_size:
+            name = file.name
+        else:
+            preview = img.resize(size, Image.ANTIALIAS)
+            name, _ = self._store(rendering.encode(preview, img.format or 'JPEG'), self.preview_filename(file.name))
+        info = {
+            'name': name,
+            'width': size[0],
+            'height': size[1],
+            'original_width': original_size[0],
+            'original_height': original_size[1],
+        }
+        cache.set(self._preview_cache_key(file.name), info, conf.PREVIEW_CACHE_TIMEOUT)
+        manifest = self.get_manifest(instance, file.name)
+        if manifest is not None:
+            manifest['preview'] = info
+            self._set_manifest(instance, manifest)
+        return info
+
+    def _preview_cache_key(self, filename):
+        return 'awesome_imagefield:preview:%s' % hashlib.sha1(filename.encode('utf-8')).hexdigest()
+
+    def changed_versions(self, model_instance, file, version_transform_data=None):
+        """
+        Use the digests in the manifest to find the versions a save has to build.
+        Returns the crops to build them from ({version_id: crop box or None to
+        auto crop}) and the set of version ids, or (None, None) when the row has
+        no manifest to tell.
+
+        Versions missing from the manifest are always built. Recorded ones are
+        only rebuilt when their crop was submitted or `autosave_overwrite` is set,
+        and then only if the original, the crop or the spec changed.
+        """
+        manifest = self.get_manifest(model_instance, file.name)
+        if manifest is None or not manifest.get('original_hash'):
+            return None, None
+        entries = manifest['versions']
+        original_hash = manifest['original_hash']
+        check_digest = version_transform_data is not None or self.autosave_overwrite
+
+        crops = {}
+        changed = set()
+        for version_id in self.specs.roots:
+            if version_transform_data is not None:
+                if version_id not in version_transform_data:
+                    continue
+                crop = version_transform_data[version_id]
+            else:
+                crop = entries.get(version_id, {}).get('crop')
+            for tree_id in self.specs.groups[version_id]:
+                entry = entries.get(tree_id)
+                if entry is None or (check_digest and (
+                        crop is None or entry.get('digest') != self.version_digest(original_hash, crop, tree_id))):
+                    changed.add(tree_id)
+                    crops[version_id] = crop
+        return crops, changed
+
+    def generate_versions(self, model_instance, file, version_transform_data=None, only=None):
+        """
+        Crop and resize the versions described by `version_transform_data`,
+        which maps version ids to crop boxes (None to auto crop). Without it,
+        versions which do not exist yet (or all of them with `autosave_overwrite`)
+        are auto cropped.
+        """
+        recorder = stats.start(self, model_instance)
+        with recorder.stage('open'):
+            img_pil_org = self.open_original(file)
+
+        if version_transform_data is None:
+            # check if a image version already exists
+            version_transform_data = dict()
+            manifest = self.get_manifest(model_instance, file.name)
+            for version_id in self.specs.roots:
+                version_data = self.flat_versions[version_id]
+                # OK to overwrite image of the same name if `overwrite` flag was passed
+                if self.autosave_overwrite:
+                    exists = False
+                elif manifest is not None:
+                    exists = version_id in manifest['versions']
+                else:
                     # does a version allready exist?
                     # If so dont create a automatic one for no reason
-                    filename = version_data['upload_to'](model_instance, file.name)
-                    # import pdb; pdb.set_trace()
-                    # OK to overwrite image of the same name if `overwrite` flag was passed
-                    if (file.field.autosave_overwrite) or (not file.field.storage.exists(filename)):
-                        vt_data[version_id] = self.gen_auto_crop_version(version_data, img_pil_org)
-                file.version_transform_data = vt_data
-
-            # Loop through image versions present on BCImage edit page or auto
-            # those which have been auto created
-            for version_id, version_data in file.version_transform_data.items():
-
-                version = file.field.versions[version_id]
-                crop = img_pil_org.crop((version_data['x'], version_data['y'], version_data['x2'], version_data['y2']))
-                if version['width'] != (version_data['x2'] - version_data['x']):
-                    crop = crop.resize((version['width'], version['height']), Image.ANTIALIAS)
-                self._file_save(crop, version, img_pil_org.format, model_instance, file)
-
-                # Manually cropped version is now saved; now auto-save resized variants of it.
-                # File object just saved is "crop" - rename to avoid confusion (we're done cropping).
-                newimg = crop
-
-                # Save multiple resized versions of the cropped image
-                if 'autosize_versions' in version:
-                    for version, attribs in version['autosize_versions'].items():
-                        newimg = newimg.resize((attribs['width'], attribs['height']), Image.ANTIALIAS)
-                        self._file_save(newimg, attribs, img_pil_org.format, model_instance, file)
-
-            delattr(file, 'version_transform_data')
-        return file
+                    filename = self.version_filename(version_data, model_instance, file.name)
+                    exists = self.storage.exists(filename)
+                    if exists:
+                        self._record_existing_versions(model_instance, file, version_id, version_data)
+                if not exists:
+                    version_transform_data[version_id] = None
+
+        # Loop through image versions present on BCImage edit page or auto
+        # those which have been auto created. Every crop and its autosize
+        # versions form an independent branch which can be rendered in parallel.
+        crops = {}
+        regions = []
+        auto_cropped = set()
+        for version_id, version_data in version_transform_data.items():
+
+            version = self.flat_versions[version_id]
+            if version_data is None:
+                version_data = self.gen_auto_crop_version(version, img_pil_org)
+                auto_cropped.add(version_id)
+            box = (version_data['x'], version_data['y'], version_data['x2'], version_data['y2'])
+            plan = self.resize_plans[version_id]
+            if only is not None:
+                plan = planning.prune_plan(plan, only)
+                if not plan:
+                    continue
+            crops[version_id] = version_data
+            regions.append((version_id, box, plan))
+
+        if not regions:
+            return {}
+
+        # Only decode as many pixels as the largest version of every crop needs
+        # (plans start with their largest step), and the cropper's preview
+        decode_regions = [(box, plan[0][1]) for _, box, plan in regions]
+        manifest = self.get_manifest(model_instance, file.name)
+        needs_preview = manifest is not None and 'preview' not in manifest
+        if needs_preview:
+            decode_regions.append(((0, 0) + img_pil_org.size, self.preview_size(img_pil_org.size)))
+        factor = planning.decode_reduction(decode_regions, conf.DECODE_OVERSAMPLE)
+        with limits.decoding(planning.decoded_size(img_pil_org, factor)):
+            with recorder.stage('decode'):
+                img_pil_org, scale = planning.reduced_decode(img_pil_org, factor)
+                img_pil_org.load()
+            if needs_preview:
+                # the original is decoded anyway; saves opening it again in the admin
+                with recorder.stage('preview'):
+                    self.build_preview(model_instance, file, img_pil_org, scale)
+
+            # The crop and its autosize versions are resized following the field's
+            # resize plan; every part of the plan that starts from the crop is a
+            # separate branch.
+            branches = []
+            with recorder.stage('crop'):
+                for version_id, box, plan in regions:
+                    if version_id in auto_cropped and cropping.get_auto_crop().needs_pixels:
+                        # now the pixels are there, place the automatic crop
+                        crops[version_id] = self.gen_auto_crop_version(
+                            self.flat_versions[version_id], img_pil_org, scale)
+                        box = tuple(crops[version_id][coord] for coord in ('x', 'y', 'x2', 'y2'))
+                    crop = img_pil_org.crop(planning.scale_box(box, scale, img_pil_org.size))
+                    branches.extend((crop, steps) for steps in planning.split_plan(plan))
+
+            manifest = self.get_manifest(model_instance, file.name)
+            original_hash = manifest.get('original_hash') if manifest else None
+
+            def digest(version_id):
+                if not original_hash:
+                    return None
+                crop = crops[self.flat_versions[version_id].parent or version_id]
+                return self.version_digest(original_hash, crop, version_id)
+
+            done = self._store_rendered(model_instance, file, branches, img_pil_org.format, only, recorder,
+                                        crops, digest)
+        return done()
+
+    def regenerate_versions(self, instance, version_ids):
+        """Rebuild the versions in `version_ids`, re-using stored crops and auto cropping the rest"""
+        file = getattr(instance, self.attname)
+        manifest = self.get_manifest(instance, file.name) or {'versions': {}}
+        version_ids = set(version_ids)
+        version_transform_data = {}
+        for version_id in self.specs.roots:
+            if set(self.specs.groups[version_id]) & version_ids:
+                version_transform_data[version_id] = manifest['versions'].get(version_id, {}).get('crop')
+        return self.generate_versions(instance, file, version_transform_data, only=version_ids)
+
+    def _record_existing_versions(self, model_instance, file, version_id, version):
+        """Add versions built before the manifest existed to it, so they are not looked up again"""
+        if not self.manifest_field:
+            return
+        for existing_id in self.specs.groups[version_id]:
+            name = self.version_filename(self.flat_versions[existing_id], model_instance, file.name)
+            self.record_version(model_instance, file.name, existing_id, self._existing_entry(existing_id, name))
 
 
 class SquareAutoCropVersionedImageField(BaseVersionedImageField):
+    def plan_resizes(self):
+        """All versions are resized from the same square, so they share one plan"""
+        # width both times just to be certain
+        targets = [(version_id, (spec.width, spec.width)) for version_id, spec in self.flat_versions.items()]
+        return {None: planning.plan_resizes(targets, conf.RESIZE_MIN_RATIO)}
+
     def pre_save(self, model_instance, add):
         """Create our autocropped image versions"""
 
         file = super(SquareAutoCropVersionedImageField, self).pre_save(model_instance, add)
         # _file will be None except on new uploads
-        if file and (getattr(file, '_file') or hasattr(model_instance, '_porting_images_flag')):
-            fp = file._file
-            # HACK TODO for profile image porting; remove after launch
-            if getattr(model_instance, '_porting_images_flag', False):
-                fp = getattr(model_instance, self.attname)
-
-            fp.open()  # reopen just in case, which sets Django's File-like object to seek=0
-            img_pil_org = Image.open(fp)
-
-            # Crop: find largest square that fits in the image
-            org_w, org_h = img_pil_org.size
-            minsize = min(org_w, org_h)  # get the smaller dimension
-            w_offset = int((org_w - minsize) / 2)
-            h_offset = int((org_h - minsize) / 2)
-            square = img_pil_org.crop((w_offset, h_offset, w_offset + minsize, h_offset + minsize))
-
-            # Resize: create all the different file versions
-            for _, version in self.versions.items():
-                # width both times just to be certain
-                new = square.resize((version['width'], version['width']), Image.ANTIALIAS)
-                self._file_save(new, version, img_pil_org.format, model_instance, file)
+        if file and not self.lazy and (getattr(file, '_file') or hasattr(model_instance, '_porting_images_flag')):
+            manifest = self.get_manifest(model_instance, file.name)
+            if manifest and manifest.get('original_hash') and all(
+                    manifest['versions'].get(version_id, {}).get('digest') ==
+                    self.version_digest(manifest['original_hash'], None, version_id)
+                    for version_id in self.flat_versions):
+                # the same image was uploaded again
+                return file
+            if self.deferred:
+                self.defer_versions(model_instance)
+            else:
+                self.generate_versions(model_instance, file)
         return file
+
+    def generate_versions(self, model_instance, file, version_transform_data=None, only=None):
+        """Crop the largest square (centered, or placed by the auto crop strategy) and resize it to every version"""
+
+        fp = file._file
+        # HACK TODO for profile image porting; remove after launch
+        # (deferred backends also get here with a file fresh from storage)
+        if getattr(model_instance, '_porting_images_flag', False) or not fp:
+            fp = getattr(model_instance, self.attname)
+
+        recorder = stats.start(self, model_instance)
+        with recorder.stage('open'):
+            if fp is file._file:
+                fp.open()  # reopen just in case, which sets Django's File-like object to seek=0
+                img_pil_org = Image.open(fp)
+            else:
+                img_pil_org = self.open_original(fp)
+
+        # Crop: find largest square that fits in the image
+        largest = max(spec.width for spec in self.flat_versions.values())
+        square_version = {'width': largest, 'height': largest}
+        square_box = self.gen_auto_crop_version(square_version, img_pil_org)
+        box = (square_box['x'], square_box['y'], square_box['x2'], square_box['y2'])
+
+        # Only decode as many pixels as the largest version needs
+        factor = planning.decode_reduction([(box, (largest, largest))], conf.DECODE_OVERSAMPLE)
+        with limits.decoding(planning.decoded_size(img_pil_org, factor)):
+            with recorder.stage('decode'):
+                img_pil_org, scale = planning.reduced_decode(img_pil_org, factor)
+                img_pil_org.load()
+            with recorder.stage('crop'):
+                if cropping.get_auto_crop().needs_pixels:
+                    square_box = self.gen_auto_crop_version(square_version, img_pil_org, scale)
+                    box = (square_box['x'], square_box['y'], square_box['x2'], square_box['y2'])
+                square = img_pil_org.crop(planning.scale_box(box, scale, img_pil_org.size))
+
+            # Resize: create all the different file versions, smaller ones from larger ones
+            plan = self.resize_plans[None]
+            if only is not None:
+                plan = planning.prune_plan(plan, only)
+            branches = [(square, steps) for steps in planning.split_plan(plan)]
+
+            manifest = self.get_manifest(model_instance, file.name)
+            original_hash = manifest.get('original_hash') if manifest else None
+
+            def digest(version_id):
+                return self.version_digest(original_hash, None, version_id) if original_hash else None
+
+            done = self._store_rendered(model_instance, file, branches, img_pil_org.format, only, recorder,
+                                        {}, digest)
+        return done()
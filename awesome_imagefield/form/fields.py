@@ -1,9 +1,17 @@
 from django import forms
+from django.core.files.uploadedfile import UploadedFile
+
+from .. import conf, limits
 from .widgets import VersionedImageCropperInput
 
 
 class VersionedImageField(forms.ImageField):
     widget = VersionedImageCropperInput
+    default_error_messages = {
+        'too_many_pixels': u"This image is too large: %(width)s x %(height)s pixels, "
+                           u"the limit is %(max)s megapixels.",
+        'too_large': u"This file is too large: the limit is %(max)s MB.",
+    }
 
     def clean(self, data, initial=None):
         """
@@ -22,6 +30,8 @@ class VersionedImageField(forms.ImageField):
             image_file = data
             crop_data = {}
 
+        if isinstance(image_file, UploadedFile):
+            self.check_limits(image_file)
         original = super(VersionedImageField, self).clean(image_file, initial)
         vtd = {}
         for version_id, version_data in crop_data.items():
@@ -38,8 +48,25 @@ class VersionedImageField(forms.ImageField):
                     #Throw ValidationError instead
                     del vtd[version_id]
                     break
-                #Check data - throw validationerror if !(x > x2) or !(y > y2)
+            else:
+                if vtd[version_id]['x2'] <= vtd[version_id]['x'] or vtd[version_id]['y2'] <= vtd[version_id]['y']:
+                    #Throw ValidationError instead
+                    del vtd[version_id]
                 #maybe test and make sure the coords are within the image range
         if original and vtd:
             original.version_transform_data = vtd
         return original
+
+    def check_limits(self, image_file):
+        """Refuse uploads over the size limits before any of their pixels are decoded"""
+        if conf.MAX_UPLOAD_SIZE and image_file.size > conf.MAX_UPLOAD_SIZE:
+            raise forms.ValidationError(self.error_messages['too_large'] % {
+                'max': conf.MAX_UPLOAD_SIZE // (1024 * 1024)})
+        try:
+            info = limits.probe(image_file)
+        except Exception:
+            # not an image; forms.ImageField reports it
+            return
+        if conf.MAX_PIXELS and info['width'] * info['height'] > conf.MAX_PIXELS:
+            raise forms.ValidationError(self.error_messages['too_many_pixels'] % {
+                'width': info['width'], 'height': info['height'], 'max': conf.MAX_PIXELS // (1000 * 1000)})
@@ -20,17 +20,29 @@ class VersionedImageCropperInput(ClearableFileInput):
         file_browser = super(VersionedImageCropperInput, self).render(name, value, attrs)
         crop_fields = ""
         if value and hasattr(value, 'field'):
-            for version_id, version in value.field.versions.items():
+            pending = value.versions.pending
+            # the cropper works on a downscaled copy, the original can be huge
+            try:
+                preview, scale, original_size = value.field.get_preview(value.instance, value)
+            except IOError:
+                preview, scale, original_size = value, (1.0, 1.0), (value.width, value.height)
+            for version_id in value.field.specs.roots:
+                version = value.field.flat_versions[version_id]
                 cropfield_map = dict(map(lambda x: (x, self.getFieldName(name, version_id, x)), self.fields))
                 version_params = {
                     'name': self.getFieldPrefixVersioned(name, version_id),
-                    'label': version['label'],
+                    'label': version.label,
                     'original': value,
+                    'preview': preview,
+                    'scale': json.dumps(scale),
+                    'original_width': original_size[0],
+                    'original_height': original_size[1],
                     'version': getattr(value.versions, version_id),
+                    'pending': pending,
                     'hidden_inputs': cropfield_map.values(),
                     'cropfield_map': json.dumps(cropfield_map),
-                    'width': version['width'],
-                    'height': version['height']
+                    'width': version.width,
+                    'height': version.height
                 }
                 crop_fields += render_to_string('widgets/imageversion.html', version_params)
 
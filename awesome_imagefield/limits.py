@@ -0,0 +1,96 @@
+"""
+Guards against uploads which take too much memory to process.
+
+probe() reads what an image is from its header alone, so the form field can
+refuse oversized uploads before anything is decoded, and the model field can
+keep it for later dimension reads. Decoding for versions goes through a
+process-wide pixel budget: once decoded images would hold more than
+AWESOME_IMAGEFIELD_DECODE_PIXEL_BUDGET pixels, further decodes wait for
+running ones to finish instead of adding to the peak memory.
+"""
+import threading
+from contextlib import contextmanager
+
+from PIL import Image
+
+from . import conf
+
+
+# EXIF tag of the orientation the camera was held in; 1 is upright
+EXIF_ORIENTATION = 0x0112
+
+
+def probe(file):
+    """
+    The width, height, mode, format, EXIF orientation and byte size of an
+    image file, read from its header without decoding the pixels. Leaves the
+    file at position 0.
+    """
+    file.seek(0)
+    img = Image.open(file)
+    info = {
+        'width': img.size[0],
+        'height': img.size[1],
+        'mode': img.mode,
+        'format': img.format,
+        'orientation': _orientation(img),
+        'size': getattr(file, 'size', None),
+    }
+    file.seek(0)
+    return info
+
+
+def _orientation(img):
+    getexif = getattr(img, '_getexif', None)  # only formats which carry EXIF
+    if getexif is None:
+        return 1
+    try:
+        exif = getexif() or {}
+    except Exception:  # broken EXIF doesn't make a broken image
+        return 1
+    return exif.get(EXIF_ORIENTATION, 1)
+
+
+class PixelBudget(object):
+    """
+    Lets threads hold up to `pixels` decoded pixels in total; reserve() blocks
+    until its share is available. A single reservation larger than the whole
+    budget waits for every other one to finish and then runs alone.
+    """
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, pixels):
+        pixels = min(pixels, self.pixels)
+        with self.condition:
+            while self.reserved and self.reserved + pixels > self.pixels:
+                self.condition.wait()
+            self.reserved += pixels
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.reserved -= pixels
+                self.condition.notify_all()
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+@contextmanager
+def decoding(size):
+    """Hold a share of the process' pixel budget while an image of `size` is decoded and used"""
+    global _budget
+    if not conf.DECODE_PIXEL_BUDGET:
+        yield
+        return
+    with _budget_lock:
+        if _budget is None:
+            _budget = PixelBudget(conf.DECODE_PIXEL_BUDGET)
+    with _budget.reserve(size[0] * size[1]):
+        yield
@@ -0,0 +1,30 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from awesome_imagefield import superseded
+
+
+class Command(BaseCommand):
+    help = ("Delete fingerprinted version files which were replaced more than "
+            "AWESOME_IMAGEFIELD_SUPERSEDED_GRACE seconds ago and are no longer referred to")
+    option_list = BaseCommand.option_list + (
+        make_option('--grace', type='int', default=None,
+                    help='Seconds a replaced file is kept (default: AWESOME_IMAGEFIELD_SUPERSEDED_GRACE)'),
+        make_option('--limit', type='int', default=None,
+                    help='Look at most at this many files per run'),
+        make_option('--loop', action='store_true', default=False,
+                    help='Keep collecting instead of exiting'),
+        make_option('--sleep', type='float', default=60,
+                    help='Seconds to wait between runs when --loop is given'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = superseded.collect(grace=options['grace'], limit=options['limit'])
+            if int(options['verbosity']) > 1:
+                self.stdout.write("Deleted %d superseded files\n" % deleted)
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
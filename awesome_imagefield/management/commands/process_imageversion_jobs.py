@@ -0,0 +1,32 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from awesome_imagefield.backends import DatabaseBackend, get_backend
+
+
+class Command(BaseCommand):
+    help = "Build the image versions queued by fields declared with `deferred=True`"
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=None,
+                    help='Process at most this many jobs per run'),
+        make_option('--loop', action='store_true', default=False,
+                    help='Keep polling for new jobs instead of exiting'),
+        make_option('--sleep', type='float', default=5,
+                    help='Seconds to wait between polls when --loop is given'),
+    )
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        if not isinstance(backend, DatabaseBackend):
+            raise CommandError("AWESOME_IMAGEFIELD_DEFERRED_BACKEND is not a DatabaseBackend")
+
+        while True:
+            processed = backend.process(limit=options['limit'])
+            if int(options['verbosity']) > 1:
+                self.stdout.write("Processed %d image version jobs\n" % processed)
+            if not options['loop']:
+                break
+            if not processed:
+                time.sleep(options['sleep'])
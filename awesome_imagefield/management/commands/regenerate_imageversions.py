@@ -0,0 +1,177 @@
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import get_model
+
+
+def regenerate_chunk(app_label, model_name, field_name, pks, force=False, dry_run=False, version_ids=None):
+    """
+    Rebuild the stale versions of the rows in `pks`.
+    Returns (images rendered, versions rendered, bytes written, errors).
+    """
+    model = get_model(app_label, model_name)
+    field = model._meta.get_field(field_name)
+    images = versions = nbytes = 0
+    errors = []
+    for instance in model._default_manager.filter(pk__in=pks).order_by('pk'):
+        try:
+            if not getattr(instance, field.attname):
+                continue
+            if force:
+                stale = set(field.flat_versions)
+            else:
+                stale = field.stale_versions(instance)
+            if version_ids:
+                stale &= set(version_ids)
+            if not stale:
+                continue
+            if not dry_run:
+                loaded = getattr(instance, field.manifest_field) if field.manifest_field else None
+                written = field.regenerate_versions(instance, stale)
+                nbytes += sum(written.values())
+                # an admin save since the chunk was loaded wins; --resume retries the row
+                if not field.save_manifest(instance, expected=loaded):
+                    errors.append((instance.pk, "saved while its versions were rebuilt; run again to retry"))
+                    continue
+            images += 1
+            versions += len(stale)
+        except Exception as e:
+            errors.append((instance.pk, repr(e)))
+    return images, versions, nbytes, errors
+
+
+class Command(BaseCommand):
+    args = '<app_label.Model> <field_name>'
+    help = ("Rebuild the image versions of existing rows whose version spec changed or whose "
+            "files are missing. Progress is checkpointed so an interrupted run can be resumed.")
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=100,
+                    help='Rows handed to a worker at a time'),
+        make_option('--workers', type='int', default=None,
+                    help='Worker processes (default: one per core, 0: render in this process)'),
+        make_option('--versions', default=None,
+                    help='Comma separated version ids to limit the run to'),
+        make_option('--force', action='store_true', default=False,
+                    help='Rebuild every version, not only missing or changed ones'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only report what would be rebuilt'),
+        make_option('--resume', action='store_true', default=False,
+                    help='Continue after the last row recorded in the checkpoint file'),
+        make_option('--checkpoint', default=None,
+                    help='Checkpoint file (default: .regenerate_imageversions.<model>.<field>.json)'),
+    )
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options['verbosity'])
+        if len(args) != 2 or '.' not in args[0]:
+            raise CommandError("Usage: regenerate_imageversions %s" % self.args)
+        app_label, model_name = args[0].split('.', 1)
+        field_name = args[1]
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError("Unknown model %s" % args[0])
+        field = model._meta.get_field(field_name)
+        if not hasattr(field, 'regenerate_versions'):
+            raise CommandError("%s.%s is not a versioned image field" % (args[0], field_name))
+
+        version_ids = options['versions'].split(',') if options['versions'] else None
+        if version_ids and set(version_ids) - set(field.flat_versions):
+            raise CommandError("Unknown versions: %s" % ', '.join(set(version_ids) - set(field.flat_versions)))
+
+        checkpoint = options['checkpoint'] or '.regenerate_imageversions.%s.%s.%s.json' % (
+            app_label, model_name, field_name)
+        last_pk = None
+        if options['resume'] and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                last_pk = json.load(f)['last_pk']
+            self.stdout.write("Resuming after pk %s\n" % last_pk)
+
+        job = (app_label, model_name, field_name)
+        job_options = dict(force=options['force'], dry_run=options['dry_run'], version_ids=version_ids)
+
+        executor = None
+        workers = options['workers'] if options['workers'] is not None else multiprocessing.cpu_count()
+        if workers:
+            executor = ProcessPoolExecutor(max_workers=workers)
+        # keep a bounded number of chunks in flight; results are handled in pk order
+        # so the checkpoint never skips over an unfinished chunk
+        window = workers * 2
+
+        totals = {'rows': 0, 'images': 0, 'versions': 0, 'bytes': 0, 'errors': 0}
+        # the checkpoint never moves past a row that failed, so --resume retries it
+        state = {'checkpoint': last_pk, 'failed': False}
+        started = time.time()
+        in_flight = deque()
+
+        def finish(pks, result):
+            images, versions, nbytes, errors = result
+            totals['rows'] += len(pks)
+            totals['images'] += images
+            totals['versions'] += versions
+            totals['bytes'] += nbytes
+            totals['errors'] += len(errors)
+            for pk, error in errors:
+                self.stderr.write("pk %s: %s\n" % (pk, error))
+            if not state['failed']:
+                if errors:
+                    first_failed = min(pk for pk, _ in errors)
+                    done = [pk for pk in pks if pk < first_failed]
+                    if done:
+                        state['checkpoint'] = done[-1]
+                    state['failed'] = True
+                else:
+                    state['checkpoint'] = pks[-1]
+                if not options['dry_run'] and state['checkpoint'] is not None:
+                    with open(checkpoint, 'w') as f:
+                        json.dump({'last_pk': state['checkpoint']}, f)
+            self.report(totals, started)
+
+        for pks in self.chunks(model, last_pk, options['chunk_size']):
+            if executor is None:
+                finish(pks, regenerate_chunk(*job, pks=pks, **job_options))
+                continue
+            # submit() may fork a worker, which must not inherit an open connection;
+            # this command runs in autocommit, so the next query simply reconnects
+            connection.close()
+            in_flight.append((pks, executor.submit(regenerate_chunk, *job, pks=pks, **job_options)))
+            while len(in_flight) >= window:
+                chunk, future = in_flight.popleft()
+                finish(chunk, future.result())
+        while in_flight:
+            chunk, future = in_flight.popleft()
+            finish(chunk, future.result())
+        if executor is not None:
+            executor.shutdown()
+
+        self.stdout.write("Done. %s\n" % self.summary(totals, started))
+        if state['failed'] and not options['dry_run']:
+            self.stdout.write("The checkpoint stops before the first failed row; "
+                              "fix the errors and run again with --resume to retry from there.\n")
+
+    def chunks(self, model, last_pk, chunk_size):
+        """Primary keys in ascending order, `chunk_size` at a time"""
+        queryset = model._default_manager.order_by('pk').values_list('pk', flat=True)
+        while True:
+            page = queryset.filter(pk__gt=last_pk) if last_pk is not None else queryset
+            pks = list(page[:chunk_size])
+            if not pks:
+                return
+            yield pks
+            last_pk = pks[-1]
+
+    def summary(self, totals, started):
+        elapsed = max(time.time() - started, 0.001)
+        return ("%(rows)d rows scanned, %(images)d images and %(versions)d versions rendered, "
+                "%(bytes)d bytes written, %(errors)d errors" % totals +
+                " (%.1f images/sec, %.1f KB/sec)" % (totals['images'] / elapsed, totals['bytes'] / 1024.0 / elapsed))
+
+    def report(self, totals, started):
+        if self.verbosity > 0:
+            self.stdout.write(self.summary(totals, started) + "\n")
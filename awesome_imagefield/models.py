@@ -0,0 +1,57 @@
+from django.db import models
+from django.utils import timezone
+
+
+class VersionJob(models.Model):
+    """
+    A queued request to build the image versions of one model instance.
+    Used by `awesome_imagefield.backends.DatabaseBackend`.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (FAILED, 'Failed'),
+    )
+
+    app_label = models.CharField(max_length=100)
+    model_name = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=255)
+    field_name = models.CharField(max_length=100)
+    # JSON encoded crop data from the form field, empty for automatic crops
+    transform_data = models.TextField(blank=True)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('pk',)
+
+    def __unicode__(self):
+        return u"%s.%s(%s).%s [%s]" % (self.app_label, self.model_name, self.object_pk, self.field_name, self.status)
+
+
+class SupersededFile(models.Model):
+    """
+    A fingerprinted version file which a saved manifest stopped referring to.
+    Created in the same transaction as the save, so a rolled back save leaves
+    none behind, and deleted by the `collect_superseded_versions` management
+    command once AWESOME_IMAGEFIELD_SUPERSEDED_GRACE has passed.
+    """
+    app_label = models.CharField(max_length=100)
+    model_name = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=255)
+    field_name = models.CharField(max_length=100)
+    name = models.CharField(max_length=255)
+    superseded = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ('pk',)
+
+    def __unicode__(self):
+        return u"%s.%s(%s).%s: %s" % (self.app_label, self.model_name, self.object_pk, self.field_name, self.name)
@@ -0,0 +1,100 @@
+"""
+A local disk cache of originals kept on remote storage.
+
+Re-crops, regenerations and lazy renders all decode the original again; on
+remote storage that means downloading it every time. With the
+AWESOME_IMAGEFIELD_ORIGINALS_CACHE_DIR setting, originals are kept in that
+directory, keyed by their storage name and modification time, and opened
+memory-mapped. The least recently used files are evicted once the cache
+grows over AWESOME_IMAGEFIELD_ORIGINALS_CACHE_SIZE bytes.
+"""
+import hashlib
+import io
+import logging
+import mmap
+import os
+
+from . import conf, streaming
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_path(storage, name):
+    """Where the current copy of `name` is cached, None when it can't be cached"""
+    if not conf.ORIGINALS_CACHE_DIR or streaming.local_path(storage, name) is not None:
+        # local files are already as close as they get
+        return None
+    try:
+        modified = storage.modified_time(name)
+    except NotImplementedError:
+        # without a modification time a replaced original can't be told apart
+        return None
+    key = hashlib.sha1(('%s\n%s' % (name, modified.isoformat())).encode('utf-8')).hexdigest()
+    return os.path.join(conf.ORIGINALS_CACHE_DIR, key + os.path.splitext(name)[1])
+
+
+def open_original(storage, name):
+    """
+    A read-only, memory-mapped copy of `name`, downloaded into the cache first
+    if it isn't there. None when the cache is off or `storage` is local.
+    """
+    path = _cache_path(storage, name)
+    if path is None:
+        return None
+    try:
+        f = io.open(path, 'rb')
+    except (IOError, OSError):
+        source = storage.open(name, 'rb')
+        try:
+            streaming.write_file(path, source)
+        finally:
+            source.close()
+        f = io.open(path, 'rb')
+        # once it's open, even this file can be evicted
+        evict()
+    else:
+        # mark as recently used
+        os.utime(path, None)
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files can't be mapped
+            return io.BytesIO()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def remember(storage, name, content):
+    """Add a freshly uploaded original to the cache, saving the first download of it"""
+    path = _cache_path(storage, name)
+    if path is None:
+        return
+    content.seek(0)
+    streaming.write_file(path, content)
+    content.seek(0)
+    evict()
+
+
+def evict(max_size=None):
+    """Delete the least recently used originals until the cache fits in `max_size` bytes"""
+    max_size = conf.ORIGINALS_CACHE_SIZE if max_size is None else max_size
+    entries = []
+    total = 0
+    for filename in os.listdir(conf.ORIGINALS_CACHE_DIR):
+        if filename.startswith('.'):
+            continue
+        path = os.path.join(conf.ORIGINALS_CACHE_DIR, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:  # evicted by another process
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            logger.debug("Could not evict %s from the originals cache", path)
+        total -= size
@@ -0,0 +1,126 @@
+"""
+Planning of the decode and resize work needed to build a set of versions.
+"""
+
+# JPEG DCT scaling supports 1/1, 1/2, 1/4 and 1/8
+MAX_DECODE_REDUCTION = 8
+
+
+def decode_reduction(regions, oversample):
+    """
+    Pick the power of two by which the original can be shrunk while decoding.
+
+    `regions` is a list of (box, (width, height)) pairs: a crop box on the
+    original and the largest size rendered from it. Every box keeps at least
+    `oversample` source pixels per output pixel in both directions.
+    """
+    if not oversample or not regions:
+        return 1
+    headroom = min(
+        min((box[2] - box[0]) / float(size[0]), (box[3] - box[1]) / float(size[1]))
+        for box, size in regions
+    ) / oversample
+    factor = 1
+    while factor * 2 <= min(headroom, MAX_DECODE_REDUCTION):
+        factor *= 2
+    return factor
+
+
+def reduced_decode(img, factor):
+    """
+    Decode `img` shrunk by about `factor`.
+
+    JPEGs are decoded straight at the smaller DCT scale, which cuts both decode
+    time and memory; other formats are decoded in full and box-reduced, which
+    still makes the crops and resizes that follow cheaper.
+    Returns the image and the (x, y) scale of the original to the returned image.
+    """
+    org_w, org_h = img.size
+    if factor > 1:
+        if img.format == 'JPEG':
+            # draft() picks the smallest scale which is still at least the requested size
+            img.draft(img.mode, (org_w // factor, org_h // factor))
+        elif hasattr(img, 'reduce'):
+            format = img.format
+            img = img.reduce(factor)
+            img.format = format
+    return img, (org_w / float(img.size[0]), org_h / float(img.size[1]))
+
+
+def decoded_size(img, factor):
+    """
+    About the largest size reduced_decode() holds `img` at: only JPEGs are
+    decoded reduced, other formats are decoded in full and reduced after.
+    """
+    if img.format != 'JPEG':
+        return img.size
+    return max(1, img.size[0] // factor), max(1, img.size[1] // factor)
+
+
+def scale_box(box, scale, size):
+    """Map a crop box on the original onto an image decoded at `scale`, staying inside `size`"""
+    x, y, x2, y2 = box
+    return (
+        max(0, int(round(x / scale[0]))),
+        max(0, int(round(y / scale[1]))),
+        min(size[0], int(round(x2 / scale[0]))),
+        min(size[1], int(round(y2 / scale[1]))),
+    )
+
+
+def plan_resizes(targets, min_ratio):
+    """
+    Order the versions built from one crop so each is resized from the
+    cheapest source that is still large enough.
+
+    `targets` is a list of (version_id, (width, height)). Returns a list of
+    (version_id, (width, height), source) steps, largest first, where source is
+    the id of an earlier step or None for the crop itself. A step only uses an
+    earlier version as its source when that version is at least `min_ratio`
+    times larger in both directions; the smallest such version wins.
+    """
+    ordered = sorted(targets, key=lambda target: (-target[1][0] * target[1][1], target[0]))
+    plan = []
+    for version_id, size in ordered:
+        source = None
+        for prior_id, prior_size, _ in plan:
+            if prior_size[0] >= size[0] * min_ratio and prior_size[1] >= size[1] * min_ratio:
+                # later steps are smaller, so the last match is the cheapest
+                source = prior_id
+        plan.append((version_id, size, source))
+    return plan
+
+
+def split_plan(plan):
+    """Split a plan into independent sub-plans, one for every step resized from the crop"""
+    branches = []
+    branch_of = {}
+    for step in plan:
+        version_id, _, source = step
+        if source is None:
+            branches.append([])
+            branch_of[version_id] = len(branches) - 1
+        else:
+            branch_of[version_id] = branch_of[source]
+        branches[branch_of[version_id]].append(step)
+    return branches
+
+
+def root_reduction(root_size, size, min_ratio):
+    """The largest power of two by which the crop can be reduced before resizing it to `size`"""
+    factor = 1
+    while (root_size[0] / (factor * 2.0) >= size[0] * min_ratio and
+           root_size[1] / (factor * 2.0) >= size[1] * min_ratio):
+        factor *= 2
+    return factor
+
+
+def prune_plan(plan, keep):
+    """The steps of `plan` needed to build the versions in `keep`, including their sources"""
+    sources = dict((version_id, source) for version_id, _, source in plan)
+    needed = set()
+    for version_id in keep:
+        while version_id in sources and version_id not in needed:
+            needed.add(version_id)
+            version_id = sources[version_id]
+    return [step for step in plan if step[0] in needed]
@@ -0,0 +1,137 @@
+"""
+Bulk lookups of image versions for pages listing many model instances.
+"""
+import os.path
+from collections import defaultdict
+
+from django.db import models
+from django.db.models.query import QuerySet
+
+
+def prefetch_versions(instances, field, versions=None):
+    """
+    Find out which `versions` (by default all of them) exist for every
+    instance in `instances` (a list or queryset) with as few storage calls as
+    possible, and hand the answers to each instance's `ImageVersionSet`.
+
+    Instances with the version manifest of an upload need no storage calls
+    at all; manifests started on rows saved before it only answer for the
+    versions they list. For the rest, storages with an `exists_many(names)`
+    method returning the set of existing names are asked once, as are
+    storages with a `list_prefix(prefix)` method returning every name under
+    `prefix` (for the common directory of all the versions). Other storages
+    get one listdir() call per directory holding several of the versions.
+    """
+    instances = list(instances)
+    if not instances:
+        return instances
+    if not isinstance(field, models.Field):
+        field = instances[0]._meta.get_field(field)
+    version_ids = versions if versions is not None else list(field.flat_versions)
+
+    # (version set, file path) of everything that has to be checked in storage
+    lookups = []
+    for instance in instances:
+        file = getattr(instance, field.attname)
+        if not file:
+            continue
+        manifest = field.get_manifest(instance, file.name)
+        if manifest is not None and manifest.get('original_hash'):
+            continue
+        for version_id in version_ids:
+            if manifest is not None and manifest['versions'].get(version_id):
+                continue
+            filepath = field.version_filename(field.flat_versions[version_id], instance, file.name)
+            if filepath:
+                lookups.append((file.versions, filepath))
+    if not lookups:
+        return instances
+
+    storage = field.storage
+    filepaths = set(filepath for _, filepath in lookups)
+    if hasattr(storage, 'exists_many'):
+        existing = set(storage.exists_many(filepaths))
+        checked = filepaths
+    elif hasattr(storage, 'list_prefix'):
+        existing = set(storage.list_prefix(_common_directory(filepaths))) & filepaths
+        checked = filepaths
+    else:
+        existing, checked = _listdirs(storage, filepaths)
+
+    for version_set, filepath in lookups:
+        if filepath in checked:
+            version_set._exists[filepath] = filepath in existing
+    return instances
+
+
+def _common_directory(filepaths):
+    """The deepest directory (with a trailing slash, or '') holding all of `filepaths`"""
+    prefix = os.path.commonprefix(list(filepaths))
+    return prefix[:prefix.rfind('/') + 1]
+
+
+def _listdirs(storage, filepaths):
+    """
+    Check `filepaths` with one listdir() per directory holding more than one
+    of them; a listing costs as much as the exists() it saves otherwise (on
+    S3, more). Returns the existing paths and the paths that were checked.
+    """
+    by_directory = defaultdict(set)
+    for filepath in filepaths:
+        by_directory[os.path.dirname(filepath)].add(filepath)
+    existing = set()
+    checked = set()
+    for directory, names in by_directory.items():
+        if len(names) < 2:
+            continue
+        try:
+            _, files = storage.listdir(directory)
+        except NotImplementedError:
+            # can't list; leave the rest to exists() on access
+            break
+        except (OSError, IOError):
+            # the directory does not exist
+            files = []
+        existing.update(names & set(os.path.join(directory, name) for name in files))
+        checked.update(names)
+    return existing, checked
+
+
+class VersionedImageQuerySet(QuerySet):
+    """A QuerySet which can prefetch image versions with prefetch_versions()"""
+
+    def __init__(self, *args, **kwargs):
+        super(VersionedImageQuerySet, self).__init__(*args, **kwargs)
+        self._prefetch_image_versions = []
+
+    def prefetch_versions(self, field, versions=None):
+        """Resolve which versions exist for the whole page when it is evaluated"""
+        clone = self._clone()
+        clone._prefetch_image_versions.append((field, versions))
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super(VersionedImageQuerySet, self)._clone(*args, **kwargs)
+        clone._prefetch_image_versions = list(self._prefetch_image_versions)
+        return clone
+
+    def iterator(self):
+        if not self._prefetch_image_versions:
+            for instance in super(VersionedImageQuerySet, self).iterator():
+                yield instance
+            return
+        instances = list(super(VersionedImageQuerySet, self).iterator())
+        for field, versions in self._prefetch_image_versions:
+            prefetch_versions(instances, field, versions)
+        for instance in instances:
+            yield instance
+
+
+class VersionedImageManager(models.Manager):
+
+    def get_query_set(self):
+        return VersionedImageQuerySet(self.model, using=self._db)
+    get_queryset = get_query_set
+
+    def prefetch_versions(self, field, versions=None):
+        return self.get_query_set().prefetch_versions(field, versions)
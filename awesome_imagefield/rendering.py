@@ -0,0 +1,174 @@
+"""
+Resizing and encoding of image versions.
+
+A save is split into independent branches: one per crop (or, for square
+fields, per version). Each branch resizes its source image through a list
+of steps and encodes every result, so branches can run side by side on the
+executor picked by the AWESOME_IMAGEFIELD_RENDER_EXECUTOR setting.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from PIL import Image
+
+from . import conf, planning, streaming
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def process_pool(max_workers):
+    """
+    A ProcessPoolExecutor whose workers are started by a fork server (or
+    spawned) rather than forked from this process, so they inherit none of
+    its threads, such as the storage I/O pool, or database connections.
+    Returns it and whether its workers are forked after all, which Python 2's
+    futures package (and Python < 3.7) always do.
+    """
+    try:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=context), False
+    except (AttributeError, TypeError):
+        return ProcessPoolExecutor(max_workers=max_workers), True
+
+
+def get_executor(kind=None):
+    """Return the shared executor for `kind` ('thread' or 'process'), None when rendering serially"""
+    kind = kind or conf.RENDER_EXECUTOR
+    if kind == 'serial':
+        return None
+    with _executors_lock:
+        if kind not in _executors:
+            max_workers = conf.RENDER_MAX_WORKERS or multiprocessing.cpu_count()
+            if kind == 'thread':
+                _executors[kind] = ThreadPoolExecutor(max_workers=max_workers)
+            elif kind == 'process':
+                _executors[kind] = process_pool(max_workers)[0]
+            else:
+                raise ValueError("Unknown AWESOME_IMAGEFIELD_RENDER_EXECUTOR %r" % kind)
+        return _executors[kind]
+
+
+# Extension used for a version stored in a format other than the original's
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp'}
+
+# Version spec keys passed on to Pillow when encoding
+ENCODER_OPTIONS = ('quality', 'optimize', 'progressive')
+
+
+def with_extension(name, format):
+    """`name` with the extension of `format`"""
+    return os.path.splitext(name)[0] + EXTENSIONS.get(format, '.' + format.lower())
+
+
+def content_type(format):
+    return 'image/%s' % format.lower()
+
+
+def encoders_for(version):
+    """
+    The (format, options) encoders of a version spec: its own file first, then
+    every format in `extra_formats`. A format of None keeps the original's.
+    `extra_formats` entries are format names or dicts with a 'format' key and
+    their own encoder options.
+    """
+    options = dict((key, version[key]) for key in ENCODER_OPTIONS if key in version)
+    encoders = [(version.get('format'), options)]
+    for extra in version.get('extra_formats', ()):
+        if isinstance(extra, dict):
+            extra = dict(extra)
+            encoders.append((extra.pop('format'), extra))
+        else:
+            encoders.append((extra, {}))
+    return encoders
+
+
+def encode(img, format, spooled=True, **options):
+    """
+    Encode a PIL image into a spooled temporary file at position 0, or
+    into bytes when `spooled` is False (results crossing process boundaries).
+    """
+    if format == 'JPEG' and img.mode not in ('RGB', 'L', 'CMYK'):
+        img = _flatten(img)
+    buf = streaming.spool()
+    img.save(buf, format, **options)
+    buf.seek(0)
+    if spooled:
+        return buf
+    data = buf.read()
+    buf.close()
+    return data
+
+
+def _flatten(img):
+    """Drop transparency onto a white background for formats without alpha"""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        return background
+    return img.convert('RGB')
+
+
+def render_branch(img, steps, format, min_ratio=None, spooled=True, encoders=None):
+    """
+    Resize `img` through the `steps` of a resize plan and encode every result.
+
+    `steps` is a list of (version_id, (width, height), source) as made by
+    planning.plan_resizes(); steps with no source are resized from `img`,
+    through a cheap power of two reduction of it when that is large enough.
+    `encoders` maps version ids to their encoders_for() list, by default
+    every version is encoded once in the original's `format`.
+    Returns a list of (version_id, [(format, encoded)], (width, height), timings)
+    where each encoded file is a file, or bytes when `spooled` is False, and
+    timings holds the seconds spent in 'resize' and 'encode'.
+    """
+    min_ratio = conf.RESIZE_MIN_RATIO if min_ratio is None else min_ratio
+    outputs = {}
+    reduced = {}
+    out = []
+    for version_id, size, source in steps:
+        started = time.time()
+        if source is not None:
+            src = outputs[source]
+        else:
+            src = img
+            factor = planning.root_reduction(img.size, size, min_ratio) if min_ratio else 1
+            if factor > 1 and hasattr(img, 'reduce'):
+                if factor not in reduced:
+                    reduced[factor] = img.reduce(factor)
+                src = reduced[factor]
+        new = src.resize(size, Image.ANTIALIAS) if src.size != size else src
+        outputs[version_id] = new
+        resized = time.time()
+        encoded = []
+        for version_format, options in (encoders or {}).get(version_id, [(None, {})]):
+            version_format = version_format or format
+            encoded.append((version_format, encode(new, version_format, spooled, **options)))
+        out.append((version_id, encoded, new.size, {'resize': resized - started, 'encode': time.time() - resized}))
+    return out
+
+
+def iter_rendered(branches, format, encoders=None, executor=None):
+    """
+    Render every (img, steps) branch, at the same time when an executor is
+    available, and yield the render_branch() results of each as soon as it
+    is done, so they can be stored while the other branches still render.
+    """
+    executor = executor if executor is not None else get_executor()
+    if executor is None or len(branches) < 2:
+        for img, steps in branches:
+            for rendered in render_branch(img, steps, format, encoders=encoders):
+                yield rendered
+        return
+    # files can't be handed back from other processes
+    spooled = not isinstance(executor, ProcessPoolExecutor)
+    futures = [executor.submit(render_branch, img, steps, format, None, spooled, encoders)
+               for img, steps in branches]
+    for future in as_completed(futures):
+        for rendered in future.result():
+            yield rendered
@@ -0,0 +1,12 @@
+from django.dispatch import Signal
+
+# Sent after every version is stored. `timings` maps stage names
+# ('resize', 'encode', 'store') to seconds.
+version_rendered = Signal(providing_args=['field', 'instance', 'version_id', 'timings', 'pixels', 'bytes'])
+
+# Sent when a field is done building the versions of an instance. `timings`
+# maps stage names ('open', 'decode', 'preview', 'crop', 'render', 'store',
+# 'total') to wall clock seconds, and 'version_resize', 'version_encode' and
+# 'version_store' to the sums of the versions' timings. `versions` maps
+# version ids to their version_rendered arguments.
+pipeline_finished = Signal(providing_args=['field', 'instance', 'timings', 'versions'])
@@ -0,0 +1,125 @@
+"""
+Compiled version specs.
+
+The `versions` dict of a field is checked and compiled once, when the field
+is added to its model, instead of being walked again on every access. Each
+version, including `autosize_versions`, becomes a VersionSpec in one flat
+table, linked to its parent and children, with its spec digest, encoders and
+(for crop versions) resize plan worked out up front.
+"""
+import hashlib
+import json
+import numbers
+
+from django.core.exceptions import ImproperlyConfigured
+
+from . import conf, planning, rendering
+
+# How far an autosize version's aspect ratio may be off its crop's. Rounding
+# to whole pixels makes small versions drift, e.g. 180x100 for 16:9 is 1.25% off.
+ASPECT_TOLERANCE = 0.02
+
+
+def version_spec_digest(version):
+    """Short fingerprint of everything in a version spec that affects its output"""
+    spec = dict((key, value) for key, value in version.items()
+                if key not in ('label', 'upload_to', 'autosize_versions'))
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+class VersionSpec(object):
+    """
+    One version of a field. Reads like the dict it was declared with
+    (`spec['width']`, `spec.get('format')`), which stays available as `attrs`.
+    """
+    __slots__ = ('id', 'attrs', 'label', 'width', 'height', 'upload_to', 'format', 'aspect',
+                 'parent', 'children', 'digest', 'encoders')
+
+    def __init__(self, version_id, attrs, parent=None):
+        self.id = version_id
+        self.attrs = attrs
+        self.label = attrs.get('label', version_id)
+        self.width = attrs['width']
+        self.height = attrs['height']
+        self.upload_to = attrs['upload_to']
+        self.format = attrs.get('format')
+        self.aspect = self.width / float(self.height)
+        # id of the crop version this one is autosized from, None for crop versions
+        self.parent = parent
+        # ids of its `autosize_versions`
+        self.children = ()
+        self.digest = version_spec_digest(attrs)
+        self.encoders = rendering.encoders_for(attrs)
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def __contains__(self, key):
+        return key in self.attrs
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def __repr__(self):
+        return '<VersionSpec %s %dx%d>' % (self.id, self.width, self.height)
+
+
+class VersionSpecs(object):
+    """
+    Every version of a field:
+
+    * `flat`: {version_id: VersionSpec} of all versions, autosize ones included
+    * `roots`: ids of the versions which are cropped, in declaration order
+    * `groups`: {root id: the ids sharing its crop and aspect ratio, root first}
+    * `plans`: {root id: resize plan of its group}, see planning.plan_resizes()
+    """
+    __slots__ = ('flat', 'roots', 'groups', 'plans')
+
+    def __init__(self):
+        self.flat = {}
+        self.roots = ()
+        self.groups = {}
+        self.plans = {}
+
+
+def compile_versions(versions, name='field', min_ratio=None):
+    """Check a field's `versions` and compile them into VersionSpecs; raises ImproperlyConfigured"""
+    min_ratio = conf.RESIZE_MIN_RATIO if min_ratio is None else min_ratio
+    specs = VersionSpecs()
+    roots = []
+    for version_id, attrs in (versions or {}).items():
+        root = _compile(specs, name, version_id, attrs)
+        children = []
+        for child_id, child_attrs in attrs.get('autosize_versions', {}).items():
+            if 'autosize_versions' in child_attrs:
+                raise ImproperlyConfigured("%s: autosize version %r can't have autosize_versions of its own"
+                                           % (name, child_id))
+            child = _compile(specs, name, child_id, child_attrs, parent=version_id)
+            if abs(child.aspect / root.aspect - 1) > ASPECT_TOLERANCE:
+                raise ImproperlyConfigured(
+                    "%s: autosize version %r is %dx%d, which is not the aspect ratio of %r (%dx%d)"
+                    % (name, child_id, child.width, child.height, version_id, root.width, root.height))
+            children.append(child_id)
+        root.children = tuple(children)
+        roots.append(version_id)
+        specs.groups[version_id] = (version_id,) + root.children
+        specs.plans[version_id] = planning.plan_resizes(
+            [(group_id, (specs.flat[group_id].width, specs.flat[group_id].height))
+             for group_id in specs.groups[version_id]], min_ratio)
+    specs.roots = tuple(roots)
+    return specs
+
+
+def _compile(specs, name, version_id, attrs, parent=None):
+    if version_id in specs.flat:
+        raise ImproperlyConfigured("%s: version id %r is used twice" % (name, version_id))
+    for key in ('width', 'height'):
+        if not isinstance(attrs.get(key), numbers.Integral) or attrs[key] <= 0:
+            raise ImproperlyConfigured("%s: version %r needs a positive integer %s" % (name, version_id, key))
+    if not callable(attrs.get('upload_to')):
+        raise ImproperlyConfigured("%s: version %r needs a callable upload_to" % (name, version_id))
+    for extra in attrs.get('extra_formats', ()):
+        if isinstance(extra, dict) and 'format' not in extra:
+            raise ImproperlyConfigured("%s: extra_formats of version %r need a 'format'" % (name, version_id))
+    spec = specs.flat[version_id] = VersionSpec(version_id, attrs, parent)
+    return spec
@@ -1,15 +1,16 @@
 var imageversion = {
+    /* scale is [x, y]: preview pixels per original pixel */
     setCropCoords: function(c, cfmap, scale){
         $.each(cfmap, function(key, value) {
-          $('#' + value).val(Math.round(c[key]/scale));
+          $('#' + value).val(Math.round(c[key] / scale[key.charAt(0) == 'x' ? 0 : 1]));
         });
     },
     doCropper: function(cfmap, id, name, width, height, scale){
         var img = $('#' + name);
         var ver = $('#' + name + '_version');
 
-        width = Math.round(width * scale);
-        height = Math.round(height * scale);
+        width = Math.round(width * scale[0]);
+        height = Math.round(height * scale[1]);
         if( ver.length > 0 ){
             $('#' + name + '_cropon').hide();
             $('#' + name + '_cropoff').show();
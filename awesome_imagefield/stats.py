@@ -0,0 +1,176 @@
+"""
+Timing instrumentation of the version pipeline.
+
+generate_versions() asks start() for a recorder. Unless a stats sink is
+configured or a receiver is connected to the signals in
+`awesome_imagefield.signals`, it gets NULL_RECORDER, which does nothing.
+"""
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+from importlib import import_module
+
+from . import conf
+from .signals import pipeline_finished, version_rendered
+
+logger = logging.getLogger(__name__)
+
+_sink = None
+
+
+def get_sink():
+    """The configured stats sink, or None"""
+    global _sink
+    if _sink is None and conf.STATS_SINK:
+        module_name, class_name = conf.STATS_SINK.rsplit('.', 1)
+        _sink = getattr(import_module(module_name), class_name)()
+    return _sink
+
+
+def start(field, instance):
+    """A recorder for one run of the pipeline"""
+    if conf.STATS_SINK or version_rendered.receivers or pipeline_finished.receivers:
+        return PipelineRecorder(field, instance)
+    return NULL_RECORDER
+
+
+class BaseStatsSink(object):
+
+    def timing(self, name, seconds):
+        raise NotImplementedError
+
+    def gauge(self, name, value):
+        raise NotImplementedError
+
+
+class LoggingSink(BaseStatsSink):
+    """Logs every measurement at DEBUG level"""
+
+    def timing(self, name, seconds):
+        logger.debug("%s: %.1fms", name, seconds * 1000)
+
+    def gauge(self, name, value):
+        logger.debug("%s: %s", name, value)
+
+
+class StatsdSink(BaseStatsSink):
+    """Sends measurements to statsd over UDP; failures are ignored"""
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (host or conf.STATSD_HOST, port or conf.STATSD_PORT)
+        self.prefix = conf.STATSD_PREFIX if prefix is None else prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, stat):
+        try:
+            self.socket.sendto(('%s.%s' % (self.prefix, stat)).encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+    def timing(self, name, seconds):
+        self._send('%s:%d|ms' % (name, seconds * 1000))
+
+    def gauge(self, name, value):
+        self._send('%s:%s|g' % (name, value))
+
+
+class MemorySink(BaseStatsSink):
+    """Aggregates count, total and max of every measurement in memory"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stats = defaultdict(lambda: {'count': 0, 'total': 0, 'max': 0})
+
+    def _add(self, name, value):
+        with self.lock:
+            stat = self.stats[name]
+            stat['count'] += 1
+            stat['total'] += value
+            stat['max'] = max(stat['max'], value)
+
+    timing = _add
+    gauge = _add
+
+
+class _Stage(object):
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, *exc_info):
+        self.recorder.timings[self.name] += time.time() - self.started
+
+
+class PipelineRecorder(object):
+    """Collects the stage timings, pixel counts and byte sizes of one pipeline run"""
+
+    def __init__(self, field, instance):
+        self.field = field
+        self.instance = instance
+        self.started = time.time()
+        self.timings = defaultdict(float)
+        self.versions = {}
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def version(self, version_id, timings, pixels, nbytes):
+        info = {'timings': timings, 'pixels': pixels, 'bytes': nbytes}
+        self.versions[version_id] = info
+        for name, seconds in timings.items():
+            # summed apart from the pipeline's own, wall clock, stages
+            self.timings['version_%s' % name] += seconds
+        version_rendered.send(sender=self.field.__class__, field=self.field, instance=self.instance,
+                              version_id=version_id, **info)
+        sink = get_sink()
+        if sink is not None:
+            prefix = '%s.%s' % (self.field.name, version_id)
+            for name, seconds in timings.items():
+                sink.timing('%s.%s' % (prefix, name), seconds)
+            sink.gauge('%s.pixels' % prefix, pixels)
+            sink.gauge('%s.bytes' % prefix, nbytes)
+
+    def finish(self):
+        self.timings['total'] = time.time() - self.started
+        timings = dict(self.timings)
+        pipeline_finished.send(sender=self.field.__class__, field=self.field, instance=self.instance,
+                               timings=timings, versions=self.versions)
+        sink = get_sink()
+        if sink is not None:
+            for name, seconds in timings.items():
+                sink.timing('%s.%s' % (self.field.name, name), seconds)
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _NullRecorder(object):
+    """Stands in for PipelineRecorder when nobody is listening"""
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def version(self, version_id, timings, pixels, nbytes):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_RECORDER = _NullRecorder()
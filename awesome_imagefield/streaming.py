@@ -0,0 +1,244 @@
+"""
+Writing encoded versions to storage with as few copies and round trips as
+the storage backend allows.
+
+Writes and deletes of a save are grouped in a WriteBatch and run on a shared,
+bounded pool of I/O threads (AWESOME_IMAGEFIELD_STORAGE_IO_WORKERS), so they
+wait on the network side by side, and while the next versions are rendered.
+"""
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files import File
+
+from . import conf
+
+logger = logging.getLogger(__name__)
+
+# read once; os.umask() can only be read by setting it, which is not thread safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def spool():
+    """A file to encode into; stays in memory up to AWESOME_IMAGEFIELD_SPOOL_MAX_SIZE bytes"""
+    return tempfile.SpooledTemporaryFile(max_size=conf.SPOOL_MAX_SIZE)
+
+
+def as_file(content):
+    """Encoded content as a file-like object at position 0"""
+    if isinstance(content, bytes):
+        return io.BytesIO(content)
+    content.seek(0)
+    return content
+
+
+def size_of(content):
+    """Byte size of a file-like object, leaving it at position 0"""
+    content.seek(0, os.SEEK_END)
+    size = content.tell()
+    content.seek(0)
+    return size
+
+
+def fingerprinted(name, content):
+    """`name` with a short hash of the encoded `content` (a file or bytes) before its extension"""
+    digest = hashlib.sha1()
+    if isinstance(content, bytes):
+        digest.update(content)
+    else:
+        content.seek(0)
+        for chunk in iter(lambda: content.read(64 * 1024), b''):
+            digest.update(chunk)
+        content.seek(0)
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, digest.hexdigest()[:10], ext)
+
+
+def local_path(storage, name):
+    """The filesystem path of `name` for local storages, None for remote ones"""
+    try:
+        return storage.path(name)
+    except NotImplementedError:
+        return None
+
+
+def write_file(path, content, permissions=None):
+    """
+    Copy the file-like `content` to the local `path` through a temporary file
+    next to it, renamed over it in a single step, so readers only ever see
+    complete files. `permissions` are set on it when given.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):  # created by a concurrent save
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            shutil.copyfileobj(content, tmp)
+        if permissions is not None:
+            os.chmod(tmp_path, permissions)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def replace(storage, name, content, overwrite=True):
+    """
+    Store `content` as `name`, replacing any existing file. Returns the stored name.
+    Without `overwrite` the caller knows nothing else is stored as `name`.
+
+    * Local storages are written with write_file(), an atomic replace in a
+      single step.
+    * Storages with a `supports_streaming_writes` attribute are written to
+      through a handle from `storage.open(name, 'wb')`.
+    * Storages which overwrite on save (django-storages' `file_overwrite`)
+      are saved to directly.
+    * Otherwise the file is deleted first so save() keeps the name.
+    """
+    path = local_path(storage, name)
+    if path is not None:
+        permissions = getattr(settings, 'FILE_UPLOAD_PERMISSIONS', None)
+        write_file(path, content, permissions if permissions is not None else 0o666 & ~_UMASK)
+        return name
+
+    if getattr(storage, 'supports_streaming_writes', False):
+        handle = storage.open(name, 'wb')
+        try:
+            shutil.copyfileobj(content, handle)
+        finally:
+            handle.close()
+        return name
+
+    if overwrite and not getattr(storage, 'file_overwrite', False):
+        # delete first to prevent save() from possibily creating a new uniquely named file
+        storage.delete(name)
+    return storage.save(name, File(content, name=os.path.basename(name)))
+
+
+_io_executor = None
+_io_executor_lock = threading.Lock()
+
+
+def get_io_executor():
+    """The shared pool of storage I/O threads, None when storage is written to in the caller's thread"""
+    global _io_executor
+    if not conf.STORAGE_IO_WORKERS:
+        return None
+    with _io_executor_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(max_workers=conf.STORAGE_IO_WORKERS)
+        return _io_executor
+
+
+class WriteBatch(object):
+    """
+    The writes and deletes of one save. Every call goes to the same storage
+    instance, so its client and connections are reused across them.
+
+    wait() returns once every operation is done. When one failed, the first
+    error is raised and the new files the batch wrote (with `overwrite` off,
+    so under names nothing else uses) are deleted again, so a failed save
+    doesn't leave half of a new set of versions behind. Files replaced in
+    place are left: they are complete, and deleting them would leave their
+    name with no file at all.
+    """
+
+    def __init__(self, storage, executor=None):
+        self.storage = storage
+        self.executor = executor if executor is not None else get_io_executor()
+        self.futures = []
+        self.callbacks = []
+        # requested name -> (stored name, seconds spent writing it)
+        self.stored = {}
+        # names which were already stored before the batch, never rolled back
+        self.kept = set()
+        # names written with `overwrite`, which may have held a file before; never rolled back
+        self.overwritten = set()
+
+    def _submit(self, func, *args):
+        if self.executor is not None:
+            future = self.executor.submit(func, *args)
+        else:
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+        self.futures.append(future)
+        return future
+
+    def replace(self, name, content, overwrite=True):
+        """Queue storing encoded `content` (a file or bytes) as `name`; returns its byte size"""
+        content = as_file(content)
+        nbytes = size_of(content)
+        if overwrite:
+            self.overwritten.add(name)
+        self._submit(self._replace, name, content, overwrite)
+        return nbytes
+
+    def keep(self, name, content):
+        """Use the file already stored as `name` for `content` instead of writing it again"""
+        content = as_file(content)
+        nbytes = size_of(content)
+        content.close()
+        self.stored[name] = (name, 0.0)
+        self.kept.add(name)
+        return nbytes
+
+    def delete(self, name):
+        """Queue deleting `name`"""
+        self._submit(self.storage.delete, name)
+
+    def then(self, callback):
+        """Call `callback` from wait(), in the waiting thread, once every operation succeeded"""
+        self.callbacks.append(callback)
+
+    def _replace(self, name, content, overwrite):
+        started = time.time()
+        try:
+            stored = replace(self.storage, name, content, overwrite)
+        finally:
+            content.close()
+        self.stored[name] = (stored, time.time() - started)
+
+    def wait(self):
+        """Wait for every queued operation; on failure roll back the writes and raise"""
+        errors = [future.exception() for future in self.futures]
+        errors = [error for error in errors if error is not None]
+        self.futures = []
+        if errors:
+            self.rollback()
+            raise errors[0]
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        """Wait for queued operations and delete the new files the batch wrote"""
+        for future in self.futures:
+            future.exception()
+        self.futures = []
+        self.callbacks = []
+        for name, (stored, _) in self.stored.items():
+            if name in self.kept or name in self.overwritten:
+                continue
+            try:
+                self.storage.delete(stored)
+            except Exception:
+                logger.exception("Could not delete %s while rolling back a failed save", stored)
+        self.stored = {}
@@ -0,0 +1,73 @@
+"""
+Deleting fingerprinted version files once nothing refers to them.
+
+A fingerprinted file is never overwritten, so pages and caches may keep
+pointing at its url after a re-crop replaced it. Replaced files are recorded
+as SupersededFile rows, in the transaction of the save that replaced them,
+and are only deleted by the `collect_superseded_versions` management command
+once AWESOME_IMAGEFIELD_SUPERSEDED_GRACE seconds have passed, and if the
+row's current manifest doesn't refer to them again.
+"""
+import logging
+from datetime import timedelta
+from itertools import groupby
+
+from django.db.models import get_model
+from django.utils import timezone
+
+from . import conf
+
+logger = logging.getLogger(__name__)
+
+
+def supersede(instance, field, names):
+    """Record the files `names` of `field` on `instance` for deletion"""
+    from .models import SupersededFile
+    SupersededFile.objects.bulk_create([
+        SupersededFile(app_label=instance._meta.app_label, model_name=instance._meta.object_name,
+                       object_pk=str(instance.pk), field_name=field.name, name=name)
+        for name in sorted(names)
+    ])
+
+
+def collect(grace=None, limit=None):
+    """
+    Delete the superseded files recorded more than `grace` seconds ago which
+    the manifest of their row doesn't refer to. Returns the number deleted.
+    """
+    from .models import SupersededFile
+    grace = conf.SUPERSEDED_GRACE if grace is None else grace
+    due = SupersededFile.objects.filter(superseded__lte=timezone.now() - timedelta(seconds=grace)).order_by(
+        'app_label', 'model_name', 'object_pk', 'field_name', 'pk')
+    if limit:
+        due = due[:limit]
+
+    deleted = 0
+    key = lambda row: (row.app_label, row.model_name, row.object_pk, row.field_name)
+    for (app_label, model_name, object_pk, field_name), rows in groupby(list(due), key):
+        rows = list(rows)
+        model = get_model(app_label, model_name)
+        field = model._meta.get_field(field_name)
+        referenced = set()
+        try:
+            instance = model._default_manager.get(pk=object_pk)
+        except model.DoesNotExist:
+            instance = None
+        if instance is not None:
+            # re-read; a later crop may have gone back to one of these files
+            manifest = field._parsed_manifest(instance)
+            if manifest is not None:
+                referenced = field._recorded_names(manifest['versions'].values())
+        done = []
+        for row in rows:
+            if row.name not in referenced:
+                try:
+                    field.storage.delete(row.name)
+                except Exception:
+                    # kept for the next run
+                    logger.exception("Could not delete superseded file %s", row.name)
+                    continue
+                deleted += 1
+            done.append(row.pk)
+        SupersededFile.objects.filter(pk__in=done).delete()
+    return deleted
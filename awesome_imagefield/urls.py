@@ -0,0 +1,6 @@
+from django.conf.urls import patterns, url
+
+urlpatterns = patterns('awesome_imagefield.views',
+    url(r'^(?P<app_label>\w+)/(?P<model_name>\w+)/(?P<object_pk>[^/]+)/(?P<field_name>\w+)/(?P<version_id>\w+)/$',
+        'render_version', name='awesome_imagefield_version'),
+)
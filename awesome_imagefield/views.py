@@ -0,0 +1,73 @@
+import time
+
+from django.core.cache import cache
+from django.db.models import get_model
+from django.http import Http404, HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+
+from . import conf
+
+
+def _version_name(field, instance, file, version_id):
+    """Storage name of a version if it has been built, else None"""
+    manifest = field.get_manifest(instance, file.name)
+    if manifest is not None:
+        entry = manifest['versions'].get(version_id)
+        if entry or manifest.get('original_hash'):
+            return entry['name'] if entry else None
+    name = field.version_filename(field.flat_versions[version_id], instance, file.name)
+    return name if field.storage.exists(name) else None
+
+
+def render_version(request, app_label, model_name, object_pk, field_name, version_id):
+    """
+    Build a version of a `lazy` field on its first request and redirect to it.
+    Renders of one image hold a lock on it and start from its latest saved
+    manifest, so concurrent first requests wait for a single render of each
+    version and don't drop each other's manifest entries.
+    """
+    model = get_model(app_label, model_name)
+    if model is None:
+        raise Http404
+    try:
+        field = model._meta.get_field(field_name)
+    except Exception:
+        raise Http404
+    if not getattr(field, 'lazy', False) or version_id not in field.flat_versions:
+        raise Http404
+    instance = get_object_or_404(model, pk=object_pk)
+    file = getattr(instance, field.attname)
+    if not file:
+        raise Http404
+
+    name = _version_name(field, instance, file, version_id)
+    if name is None:
+        lock_key = 'awesome_imagefield:render:%s.%s:%s:%s' % (app_label, model_name, object_pk, field_name)
+        deadline = time.time() + conf.LAZY_LOCK_TIMEOUT
+        while name is None and time.time() < deadline:
+            if cache.add(lock_key, True, conf.LAZY_LOCK_TIMEOUT):
+                try:
+                    # reload; another request may have finished it meanwhile
+                    instance = model._default_manager.get(pk=object_pk)
+                    file = getattr(instance, field.attname)
+                    name = _version_name(field, instance, file, version_id)
+                    if name is None:
+                        loaded = getattr(instance, field.manifest_field) if field.manifest_field else None
+                        field.regenerate_versions(instance, [version_id])
+                        # an admin save may have changed the row meanwhile; then try again
+                        if field.save_manifest(instance, expected=loaded):
+                            name = _version_name(field, instance, file, version_id)
+                finally:
+                    cache.delete(lock_key)
+            else:
+                # someone else is rendering a version of this image; only look
+                # at the row again once they are done
+                while cache.get(lock_key) and time.time() < deadline:
+                    time.sleep(0.1)
+                instance = model._default_manager.get(pk=object_pk)
+                file = getattr(instance, field.attname)
+                name = _version_name(field, instance, file, version_id)
+        if name is None:
+            raise Http404
+
+    return HttpResponseRedirect(field.storage.url(name))
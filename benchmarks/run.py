@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the image version pipeline.
+
+Runs offline against a throwaway MEDIA_ROOT and the `example_app` version
+config. Every case runs in its own forked process so peak RSS is per case.
+Storage calls go through LatencyStorage, which adds a fixed delay to every
+call and counts them, so round trips to remote storage show up in the timings.
+Version writes are also counted as `replace`, whether they end in a rename
+(local) or in save() (`--remote`).
+
+    python benchmarks/run.py [--latency 0.02] [--remote] [--sizes 1600x1200,6000x4000]
+                             [--formats JPEG,PNG] [--repeat 3] [--output results.json]
+
+Results are printed as one JSON object per case.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MEDIA_ROOT = tempfile.mkdtemp(prefix='awesome_imagefield_bench_')
+
+from django.conf import settings
+
+settings.configure(
+    DEBUG=False,
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    INSTALLED_APPS=['awesome_imagefield', 'example_app'],
+    MEDIA_ROOT=MEDIA_ROOT,
+    MEDIA_URL='/media/',
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    ROOT_URLCONF='awesome_imagefield.urls',
+)
+
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import models
+from PIL import Image
+
+from awesome_imagefield import streaming
+from awesome_imagefield.fields import SquareAutoCropVersionedImageField
+from awesome_imagefield.form.widgets import VersionedImageCropperInput
+from example_app.models import ExampleImage
+from example_app.utils import get_version_path, image_path
+
+
+class LatencyStorage(FileSystemStorage):
+    """
+    A local storage which sleeps `latency` seconds on every call and counts
+    them. With `remote` it refuses path(), like remote storage backends do.
+    """
+
+    def __init__(self, latency=0.0, remote=False, *args, **kwargs):
+        super(LatencyStorage, self).__init__(*args, **kwargs)
+        self.latency = latency
+        self.remote = remote
+        self.calls = defaultdict(int)
+        # versions are written from the I/O threads
+        self.calls_lock = threading.Lock()
+
+    def count(self, name):
+        with self.calls_lock:
+            self.calls[name] += 1
+
+    def _call(self, name):
+        self.count(name)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def exists(self, name):
+        self._call('exists')
+        return super(LatencyStorage, self).exists(name)
+
+    def open(self, name, mode='rb'):
+        self._call('open')
+        return super(LatencyStorage, self).open(name, mode)
+
+    def save(self, name, content, *args, **kwargs):
+        self._call('save')
+        return super(LatencyStorage, self).save(name, content, *args, **kwargs)
+
+    def delete(self, name):
+        self._call('delete')
+        return super(LatencyStorage, self).delete(name)
+
+    def size(self, name):
+        self._call('size')
+        return super(LatencyStorage, self).size(name)
+
+    def url(self, name):
+        self._call('url')
+        return super(LatencyStorage, self).url(name)
+
+    def listdir(self, path):
+        self._call('listdir')
+        return super(LatencyStorage, self).listdir(path)
+
+    def modified_time(self, name):
+        self._call('modified_time')
+        return super(LatencyStorage, self).modified_time(name)
+
+    def path(self, name):
+        if self.remote:
+            raise NotImplementedError("LatencyStorage is pretending to be remote")
+        self._call('path')
+        return super(LatencyStorage, self).path(name)
+
+
+_replace = streaming.replace
+
+
+def counted_replace(storage, name, content, overwrite=True):
+    """streaming.replace(), counted; local writes never call save()"""
+    if isinstance(storage, LatencyStorage):
+        storage.count('replace')
+    return _replace(storage, name, content, overwrite)
+
+
+streaming.replace = counted_replace
+
+
+square_versions = dict(
+    ('square_%d' % width, {'label': 'Square %d' % width, 'width': width, 'height': width,
+                           'upload_to': get_version_path('square_%d' % width)})
+    for width in (600, 300, 150, 50)
+)
+
+
+class SquareImage(models.Model):
+    file = SquareAutoCropVersionedImageField(
+        upload_to=image_path(), versions=square_versions, max_length=255, manifest_field='file_manifest')
+    file_manifest = models.TextField(blank=True)
+
+    class Meta:
+        app_label = 'example_app'
+
+
+def synthetic_image(size, format, seed=0):
+    """A deterministic photo-like image: smooth random blobs with some grain"""
+    rng = random.Random(seed)
+    tile = (48, 36)
+    data = bytearray(rng.randint(0, 255) for _ in range(tile[0] * tile[1] * 3))
+    img = Image.frombytes('RGB', tile, bytes(data)).resize(size, Image.BICUBIC)
+    grain = bytearray(rng.randint(0, 255) for _ in range(64 * 64 * 3))
+    grain = Image.frombytes('RGB', (64, 64), bytes(grain)).resize(size, Image.NEAREST)
+    img = Image.blend(img, grain, 0.15)
+    buf = io.BytesIO()
+    img.save(buf, format)
+    return buf.getvalue()
+
+
+def new_instance(model, slug, data, format):
+    instance = model()
+    instance.slug = slug
+    ext = 'jpg' if format == 'JPEG' else format.lower()
+    instance.file = SimpleUploadedFile('bench.%s' % ext, data, content_type='image/%s' % ext)
+    return instance
+
+
+def case_save(model, size, format, resave=False):
+    """pre_save() of a new upload, or of a metadata-only re-save when `resave`"""
+    field = model._meta.get_field('file')
+    instance = new_instance(model, 'save-%dx%d' % size, synthetic_image(size, format), format)
+    if resave:
+        field.pre_save(instance, True)
+        field.storage.calls.clear()
+    started = time.time()
+    field.pre_save(instance, not resave)
+    elapsed = time.time() - started
+    manifest = field.get_manifest(instance, instance.file.name) or {'versions': {}}
+    written = 0
+    for entry in manifest['versions'].values():
+        written += entry['size'] or 0
+        written += sum(alternate['size'] for alternate in entry.get('alternates', {}).values())
+    return elapsed, {'bytes_written': 0 if resave else written}
+
+
+def case_versions(model, size, format, manifest=True):
+    """Reading every version's url, answered from the manifest or from storage"""
+    field = model._meta.get_field('file')
+    instance = new_instance(model, 'versions-%dx%d' % size, synthetic_image(size, format), format)
+    field.pre_save(instance, True)
+    if not manifest:
+        setattr(instance, field.manifest_field, '')
+    field.storage.calls.clear()
+    started = time.time()
+    for version_id in field.flat_versions:
+        version = getattr(instance.file.versions, version_id)
+        if version:
+            version.url
+    return time.time() - started, {}
+
+
+def case_widget(model, size, format):
+    """Rendering the admin cropper widget for a saved image"""
+    field = model._meta.get_field('file')
+    instance = new_instance(model, 'widget-%dx%d' % size, synthetic_image(size, format), format)
+    field.pre_save(instance, True)
+    field.storage.calls.clear()
+    started = time.time()
+    VersionedImageCropperInput().render('file', instance.file)
+    return time.time() - started, {}
+
+
+CASES = [
+    ('save', ExampleImage, case_save, {}),
+    ('resave', ExampleImage, case_save, {'resave': True}),
+    ('square_save', SquareImage, case_save, {}),
+    ('versions_manifest', ExampleImage, case_versions, {'manifest': True}),
+    ('versions_storage', ExampleImage, case_versions, {'manifest': False}),
+    ('widget', ExampleImage, case_widget, {}),
+]
+
+
+def run_case(conn, name, model, func, kwargs, size, format, options):
+    storage = LatencyStorage(latency=options.latency, remote=options.remote, location=MEDIA_ROOT)
+    model._meta.get_field('file').storage = storage
+    timings = []
+    for _ in range(options.repeat):
+        storage.calls.clear()
+        elapsed, info = func(model, size, format, **kwargs)
+        timings.append(elapsed)
+    result = {
+        'case': name,
+        'size': '%dx%d' % size,
+        'format': format,
+        'latency': options.latency,
+        'remote': options.remote,
+        'wall_time': min(timings),
+        'wall_times': timings,
+        # kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        # calls made by the last repetition
+        'storage_calls': dict(storage.calls),
+    }
+    result.update(info)
+    conn.send(result)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every storage call')
+    parser.add_argument('--remote', action='store_true', help='make the storage refuse path() like remote ones')
+    parser.add_argument('--sizes', default='1600x1200,4000x3000,6000x4000')
+    parser.add_argument('--formats', default='JPEG,PNG')
+    parser.add_argument('--cases', default=','.join(name for name, _, _, _ in CASES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='also write the results to this file')
+    options = parser.parse_args()
+
+    sizes = [tuple(int(n) for n in size.split('x')) for size in options.sizes.split(',')]
+    selected = options.cases.split(',')
+    results = []
+    try:
+        for name, model, func, kwargs in CASES:
+            if name not in selected:
+                continue
+            for format in options.formats.split(','):
+                for size in sizes:
+                    parent, child = multiprocessing.Pipe()
+                    process = multiprocessing.Process(
+                        target=run_case, args=(child, name, model, func, kwargs, size, format, options))
+                    process.start()
+                    child.close()  # so recv() fails instead of hanging if the case crashes
+                    result = parent.recv()
+                    process.join()
+                    results.append(result)
+                    print(json.dumps(result, sort_keys=True))
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,5 +14,9 @@ class ImageAdmin(admin.ModelAdmin):
     list_display = ('admin_image', 'title')
     list_display_links = ('admin_image', 'title')
 
+    def queryset(self, request):
+        # admin_image() shows small_3_2; look those up for the whole page at once
+        return super(ImageAdmin, self).queryset(request).prefetch_versions('file', ['small_3_2'])
+
 
 admin.site.register(ExampleImage, ImageAdmin)
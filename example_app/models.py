@@ -3,12 +3,13 @@ from django.utils.datastructures import SortedDict
 
 from .utils import get_generic_path, get_version_path, image_path
 from awesome_imagefield.fields import VersionedImageField
+from awesome_imagefield.query import VersionedImageManager
 
 
 # Dictionaries of autosize properties are referenced as 'autosize_versions'
 # from main image sizes dict. If new groupings are created in the future, they
 # must have the same aspect ratios as manual crop settings (i.e. same as the
-# `image_versions` dict below).
+# `image_versions` dict below); a mismatch raises ImproperlyConfigured at startup.
 autosize_dimensions_3_2 = SortedDict([
     ('large_3_2', {'label': 'Large 4:3', 'width': 800, 'height': 533, 'upload_to': get_version_path('large_3_2')}),
     ('med_3_2', {'label': 'Medium 4:3', 'width': 400, 'height': 267, 'upload_to': get_version_path('med_3_2')}),
@@ -36,14 +37,14 @@ class ExampleImage(models.Model):
         versions=image_versions,
         verbose_name="Image",
         max_length=255,
+        manifest_field='file_manifest',
+        width_field='width',
+        height_field='height',
     )
+    # written by `file`; lists the generated versions so reads need no storage calls
+    file_manifest = models.TextField(blank=True, editable=False)
 
-    objects = models.Manager()
-
-    def save(self, *args, **kwargs):
-        self.width = self.file.width
-        self.height = self.file.height
-        return super(self, ExampleImage).save(self, *args, **kwargs)
+    objects = VersionedImageManager()
 
     def get_absolute_url(self):
         return u"%s" % self.file.url
@@ -3,7 +3,7 @@ from distutils.core import setup
 name = 'awesome_imagefield'
 setup(
     name=name,
-    packages=[name, name+".form"],
+    packages=[name, name+".form", name+".management", name+".management.commands"],
     package_dir={name: name},
     package_data={
         name: [
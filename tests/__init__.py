@@ -0,0 +1,9 @@
+"""
+Unit tests of the parts of the pipeline which need no database or storage:
+
+    python -m unittest discover tests
+"""
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(INSTALLED_APPS=['awesome_imagefield', 'example_app'])
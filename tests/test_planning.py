@@ -0,0 +1,112 @@
+import unittest
+
+from awesome_imagefield import planning
+
+# the crops of example_app and their autosize versions
+VERSIONS_3_2 = [('max_3_2', (1200, 800)), ('large_3_2', (800, 533)), ('med_3_2', (400, 267)),
+                ('small_3_2', (180, 120))]
+VERSIONS_16_9 = [('max_16_9', (1200, 675)), ('large_16_9', (800, 450)), ('med_16_9', (400, 225)),
+                 ('small_16_9', (180, 100))]
+
+
+class FakeImage(object):
+
+    def __init__(self, size, format):
+        self.size = size
+        self.format = format
+
+
+class PlanResizesTest(unittest.TestCase):
+
+    def sources(self, targets, min_ratio=2.0):
+        return dict((version_id, source) for version_id, _, source in planning.plan_resizes(targets, min_ratio))
+
+    def test_example_3_2(self):
+        self.assertEqual(self.sources(VERSIONS_3_2), {
+            'max_3_2': None,
+            'large_3_2': None,
+            'med_3_2': 'max_3_2',
+            'small_3_2': 'med_3_2',
+        })
+
+    def test_example_16_9(self):
+        self.assertEqual(self.sources(VERSIONS_16_9), {
+            'max_16_9': None,
+            'large_16_9': None,
+            # exactly twice its size
+            'med_16_9': 'large_16_9',
+            'small_16_9': 'med_16_9',
+        })
+
+    def test_largest_first(self):
+        plan = planning.plan_resizes(list(reversed(VERSIONS_3_2)), 2.0)
+        self.assertEqual([version_id for version_id, _, _ in plan], ['max_3_2', 'large_3_2', 'med_3_2', 'small_3_2'])
+
+    def test_ratio_of_one_uses_the_next_size_up(self):
+        self.assertEqual(self.sources(VERSIONS_3_2, 1.0), {
+            'max_3_2': None,
+            'large_3_2': 'max_3_2',
+            'med_3_2': 'large_3_2',
+            'small_3_2': 'med_3_2',
+        })
+
+    def test_split_plan(self):
+        plan = planning.plan_resizes(VERSIONS_3_2, 2.0)
+        branches = [[version_id for version_id, _, _ in steps] for steps in planning.split_plan(plan)]
+        self.assertEqual(branches, [['max_3_2', 'med_3_2', 'small_3_2'], ['large_3_2']])
+
+
+class PrunePlanTest(unittest.TestCase):
+
+    def test_keeps_sources(self):
+        plan = planning.plan_resizes(VERSIONS_3_2, 2.0)
+        pruned = planning.prune_plan(plan, ['small_3_2'])
+        self.assertEqual([version_id for version_id, _, _ in pruned], ['max_3_2', 'med_3_2', 'small_3_2'])
+
+    def test_root_alone(self):
+        plan = planning.plan_resizes(VERSIONS_3_2, 2.0)
+        self.assertEqual([version_id for version_id, _, _ in planning.prune_plan(plan, ['large_3_2'])],
+                         ['large_3_2'])
+
+    def test_unknown_versions(self):
+        plan = planning.plan_resizes(VERSIONS_3_2, 2.0)
+        self.assertEqual(planning.prune_plan(plan, ['max_16_9']), [])
+
+
+class DecodeReductionTest(unittest.TestCase):
+
+    def test_keeps_oversample(self):
+        # 4x the output in both directions, 2x of it oversampled
+        self.assertEqual(planning.decode_reduction([((0, 0, 4800, 3200), (1200, 800))], 2.0), 2)
+
+    def test_smallest_headroom_wins(self):
+        regions = [((0, 0, 4800, 3200), (1200, 800)), ((0, 0, 2400, 1350), (1200, 675))]
+        self.assertEqual(planning.decode_reduction(regions, 2.0), 1)
+
+    def test_capped_at_jpeg_scaling(self):
+        self.assertEqual(planning.decode_reduction([((0, 0, 60000, 40000), (180, 120))], 2.0),
+                         planning.MAX_DECODE_REDUCTION)
+
+    def test_off(self):
+        self.assertEqual(planning.decode_reduction([((0, 0, 4800, 3200), (1200, 800))], None), 1)
+        self.assertEqual(planning.decode_reduction([], 2.0), 1)
+
+
+class SizesTest(unittest.TestCase):
+
+    def test_decoded_size_of_jpeg_is_reduced(self):
+        self.assertEqual(planning.decoded_size(FakeImage((6000, 4000), 'JPEG'), 4), (1500, 1000))
+
+    def test_decoded_size_of_other_formats_is_full(self):
+        self.assertEqual(planning.decoded_size(FakeImage((6000, 4000), 'PNG'), 4), (6000, 4000))
+
+    def test_scale_box_stays_inside(self):
+        self.assertEqual(planning.scale_box((0, 0, 4001, 3001), (4.0, 4.0), (1000, 750)), (0, 0, 1000, 750))
+
+    def test_root_reduction(self):
+        self.assertEqual(planning.root_reduction((4000, 3000), (400, 300), 2.0), 4)
+        self.assertEqual(planning.root_reduction((1200, 800), (800, 533), 2.0), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
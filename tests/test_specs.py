@@ -0,0 +1,113 @@
+import unittest
+from collections import OrderedDict
+
+from django.core.exceptions import ImproperlyConfigured
+
+from awesome_imagefield.specs import compile_versions
+
+
+def upload_to(instance, filename):
+    return filename
+
+
+def version(width, height, **attrs):
+    attrs.update(width=width, height=height, upload_to=upload_to)
+    return attrs
+
+
+class ExampleVersionsTest(unittest.TestCase):
+
+    def setUp(self):
+        from example_app.models import image_versions
+        self.specs = compile_versions(image_versions, 'ExampleImage.file')
+
+    def test_roots_and_groups(self):
+        self.assertEqual(self.specs.roots, ('max_16_9', 'max_3_2'))
+        self.assertEqual(self.specs.groups['max_16_9'], ('max_16_9', 'large_16_9', 'med_16_9', 'small_16_9'))
+        self.assertEqual(self.specs.groups['max_3_2'], ('max_3_2', 'large_3_2', 'med_3_2', 'small_3_2'))
+        self.assertEqual(len(self.specs.flat), 8)
+
+    def test_parents_and_children(self):
+        self.assertEqual(self.specs.flat['small_16_9'].parent, 'max_16_9')
+        self.assertEqual(self.specs.flat['max_3_2'].parent, None)
+        self.assertEqual(self.specs.flat['max_3_2'].children, ('large_3_2', 'med_3_2', 'small_3_2'))
+
+    def test_plans(self):
+        sources = dict((version_id, source) for root in self.specs.roots
+                       for version_id, _, source in self.specs.plans[root])
+        self.assertEqual(sources['med_3_2'], 'max_3_2')
+        self.assertEqual(sources['small_16_9'], 'med_16_9')
+
+    def test_specs_read_like_dicts(self):
+        spec = self.specs.flat['small_3_2']
+        self.assertEqual((spec['width'], spec['height']), (180, 120))
+        self.assertEqual(spec.label, 'Small 4:3')
+        self.assertFalse('format' in spec)
+        self.assertEqual(spec.get('format', 'JPEG'), 'JPEG')
+
+
+class CompileVersionsTest(unittest.TestCase):
+
+    def assertRejected(self, versions, message):
+        try:
+            compile_versions(versions, 'Model.field')
+        except ImproperlyConfigured as e:
+            self.assertTrue(message in str(e), str(e))
+            self.assertTrue(str(e).startswith('Model.field: '), str(e))
+        else:
+            self.fail("ImproperlyConfigured not raised")
+
+    def test_no_versions(self):
+        specs = compile_versions(None)
+        self.assertEqual((specs.roots, specs.flat), ((), {}))
+
+    def test_duplicate_id(self):
+        self.assertRejected(OrderedDict([
+            ('wide', version(1600, 900, autosize_versions=OrderedDict([('thumb', version(160, 90))]))),
+            ('thumb', version(100, 100)),
+        ]), "'thumb' is used twice")
+
+    def test_width_must_be_a_positive_integer(self):
+        self.assertRejected({'wide': version(0, 900)}, "positive integer width")
+        self.assertRejected({'wide': version(1600.0, 900)}, "positive integer width")
+        self.assertRejected({'wide': version('1600', 900)}, "positive integer width")
+
+    def test_height_must_be_a_positive_integer(self):
+        self.assertRejected({'wide': version(1600, -900)}, "positive integer height")
+        attrs = version(1600, 900)
+        del attrs['height']
+        self.assertRejected({'wide': attrs}, "positive integer height")
+
+    def test_upload_to_must_be_callable(self):
+        self.assertRejected({'wide': dict(version(1600, 900), upload_to='versions/wide')}, "callable upload_to")
+        attrs = version(1600, 900)
+        del attrs['upload_to']
+        self.assertRejected({'wide': attrs}, "callable upload_to")
+
+    def test_extra_formats_need_a_format(self):
+        self.assertRejected({'wide': version(1600, 900, extra_formats=[{'quality': 80}])}, "need a 'format'")
+
+    def test_nested_autosize_versions(self):
+        self.assertRejected({'wide': version(1600, 900, autosize_versions={
+            'thumb': version(160, 90, autosize_versions={'tiny': version(16, 9)}),
+        })}, "'thumb' can't have autosize_versions")
+
+    def test_aspect_ratio_within_tolerance(self):
+        # 180x100 is 1.25% off 16:9
+        specs = compile_versions({'wide': version(1600, 900, autosize_versions={'thumb': version(180, 100)})})
+        self.assertEqual(specs.flat['thumb'].parent, 'wide')
+
+    def test_aspect_ratio_mismatch(self):
+        self.assertRejected({'wide': version(1600, 900, autosize_versions={'thumb': version(180, 120)})},
+                            "'thumb' is 180x120, which is not the aspect ratio of 'wide' (1600x900)")
+
+    def test_digest_ignores_label_and_upload_to(self):
+        a = compile_versions({'wide': version(1600, 900, label='Wide')}).flat['wide']
+        b = compile_versions({'wide': dict(version(1600, 900), upload_to=lambda instance, filename: '')}).flat['wide']
+        c = compile_versions({'wide': version(1600, 900, quality=70)}).flat['wide']
+        self.assertEqual(a.digest, b.digest)
+        self.assertNotEqual(a.digest, c.digest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import Storage
+
+from awesome_imagefield import conf
+from awesome_imagefield.streaming import WriteBatch
+
+
+class MemoryStorage(Storage):
+    """A remote storage (no path()) which overwrites on save, and can't store or delete the names in `failing`"""
+    file_overwrite = True
+
+    def __init__(self, files=(), failing=()):
+        self.files = dict((name, b'old') for name in files)
+        self.failing = set(failing)
+        self.deleted = []
+
+    def _save(self, name, content):
+        if name in self.failing:
+            raise IOError("can't store %s" % name)
+        self.files[name] = content.read()
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def exists(self, name):
+        return name in self.files
+
+    def delete(self, name):
+        if name in self.failing:
+            raise IOError("can't delete %s" % name)
+        self.deleted.append(name)
+        self.files.pop(name, None)
+
+
+class WriteBatchTest(unittest.TestCase):
+    """Operations run one after another in the calling thread"""
+
+    def setUp(self):
+        self.io_workers, conf.STORAGE_IO_WORKERS = conf.STORAGE_IO_WORKERS, 0
+        self.executor = None
+
+    def tearDown(self):
+        conf.STORAGE_IO_WORKERS = self.io_workers
+
+    def batch(self, storage):
+        return WriteBatch(storage, executor=self.executor)
+
+    def test_writes_and_callbacks(self):
+        storage = MemoryStorage()
+        batch = self.batch(storage)
+        called = []
+        self.assertEqual(batch.replace('a.jpg', b'abc'), 3)
+        batch.then(lambda: called.append(True))
+        batch.wait()
+        self.assertEqual(storage.files, {'a.jpg': b'abc'})
+        self.assertEqual(called, [True])
+        self.assertEqual(batch.stored['a.jpg'][0], 'a.jpg')
+
+    def test_rollback_deletes_only_new_files(self):
+        storage = MemoryStorage(files=['kept.abc.jpg', 'small.jpg'], failing=['broken.jpg'])
+        batch = self.batch(storage)
+        called = []
+        batch.replace('large.0123456789.jpg', b'new', overwrite=False)
+        batch.replace('small.jpg', b'new')
+        batch.keep('kept.abc.jpg', b'old')
+        batch.replace('broken.jpg', b'new', overwrite=False)
+        batch.then(lambda: called.append(True))
+        self.assertRaises(IOError, batch.wait)
+        self.assertEqual(storage.deleted, ['large.0123456789.jpg'])
+        # replaced in place, or stored before the batch
+        self.assertEqual(storage.files, {'kept.abc.jpg': b'old', 'small.jpg': b'new'})
+        self.assertEqual(called, [])
+
+    def test_rollback_keeps_overwritten_files_which_failed(self):
+        storage = MemoryStorage(files=['small.jpg'], failing=['small.jpg'])
+        batch = self.batch(storage)
+        batch.replace('small.jpg', b'new')
+        self.assertRaises(IOError, batch.wait)
+        self.assertEqual(storage.deleted, [])
+        self.assertEqual(storage.files, {'small.jpg': b'old'})
+
+    def test_a_failed_delete_rolls_back(self):
+        storage = MemoryStorage(files=['old.jpg'], failing=['old.jpg'])
+        batch = self.batch(storage)
+        batch.replace('new.0123456789.jpg', b'new', overwrite=False)
+        batch.delete('old.jpg')
+        self.assertRaises(IOError, batch.wait)
+        self.assertEqual(storage.deleted, ['new.0123456789.jpg'])
+        self.assertEqual(storage.files, {'old.jpg': b'old'})
+
+
+class ThreadedWriteBatchTest(WriteBatchTest):
+    """Operations run side by side in a pool of threads"""
+
+    def setUp(self):
+        super(ThreadedWriteBatchTest, self).setUp()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super(ThreadedWriteBatchTest, self).tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()